@@ -1,7 +0,0 @@
-
-from ec2 import EC2Controller
-from opsworks import OpsworksController
-from matterhorn import MatterhornController
-from zadara import ZadaraController
-from exceptions import *
-
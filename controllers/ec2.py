@@ -2,22 +2,22 @@
 import re
 import sys
 import time
-import stopit
 import logging
 from wrapt import ObjectProxy
+from fnmatch import fnmatch
 from operator import itemgetter
+from collections import defaultdict
 from contextlib import contextmanager
 from functools import wraps
-from requests.exceptions import Timeout as RequestsTimeout
 
-import boto.ec2.networkinterface
 from boto.exception import EC2ResponseError
 
 import utils
 import settings
 from exceptions import *
+from wait import strategy_from_settings
+from history import QueueHistory, ForecastScaler, ThroughputScaler, backtest
 from zadara import ZadaraController
-from matterhorn import MatterhornController
 
 log = logging.getLogger('ec2-manager')
 
@@ -43,10 +43,91 @@ def log_before_after_stats(cmd):
         return result
     return wrapped
 
+def inventory_cache():
+    return utils.FileCache('inventory', ttl=settings.EC2M_INVENTORY_TTL)
+
+def exit_on_auth_error(service, error_class, status):
+    """
+    aws credentials aren't validated when connecting, so exit (as we would
+    have then) if the first real api call is rejected
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            except error_class, e:
+                if str(e.status) == status:
+                    log.error(e.message)
+                    log.error("Unable to establish boto.%s connection. "
+                              "Check your aws credentials.", service)
+                    sys.exit(1)
+                raise
+        return wrapped
+    return decorator
+
 class EC2Instance(ObjectProxy):
     pass
 
 
+class InstanceIndex(object):
+    """
+    Cluster instances bucketed by role and by state. A role's members are
+    worked out on first use, with a single pass over the instance list, and
+    state buckets are kept current via `update` as instances are refreshed.
+    Lists returned are in the same order as the instance list.
+    """
+
+    def __init__(self, instances):
+        self.instances = instances
+        self.position = dict((x.id, i) for i, x in enumerate(instances))
+        self.roles = {}
+        self.states = defaultdict(dict)
+        self.state_of = {}
+        for inst in instances:
+            self.update(inst)
+
+    def update(self, instance):
+        """
+        move `instance` to the bucket for its current state
+        """
+        if instance.id not in self.position:
+            return
+        old_state = self.state_of.get(instance.id)
+        if old_state == instance.state and old_state is not None:
+            return
+        if old_state is not None:
+            del self.states[old_state][instance.id]
+        self.states[instance.state][instance.id] = instance
+        self.state_of[instance.id] = instance.state
+
+    def _ordered(self, instances):
+        return sorted(instances, key=lambda x: self.position[x.id])
+
+    def role(self, name, predicate, state=None):
+        """
+        instances for which `predicate` is true, optionally only those
+        currently in `state`
+        """
+        if name not in self.roles:
+            members = [x for x in self.instances if predicate(x)]
+            self.roles[name] = (members, set(x.id for x in members))
+        members, ids = self.roles[name]
+        if state is None:
+            return members
+        bucket = self.states.get(state, {})
+        if len(bucket) < len(members):
+            return self._ordered(x for x in bucket.values() if x.id in ids)
+        return [x for x in members if x.id in bucket]
+
+    def has_role(self, name, predicate, instance):
+        self.role(name, predicate)
+        return instance.id in self.roles[name][1]
+
+    def in_state(self, state):
+        return self._ordered(self.states.get(state, {}).values())
+
+
 class EC2Controller(object):
 
     def __init__(self, cluster_prefix, dry_run=False, force=False):
@@ -61,6 +142,7 @@ class EC2Controller(object):
         self.aws_profile = settings.AWS_PROFILE
 
         self.instance_actions = []
+        self.wait_stats = []
 
     @property
     def connection(self):
@@ -83,19 +165,11 @@ class EC2Controller(object):
 
     def create_connection(self):
 
+        # credentials get checked by the first real api call; see get_instances
+        import boto.ec2
         conn = boto.ec2.connect_to_region(self.region, **self.aws_connect_params)
-
-        try:
-            conn.describe_account_attributes()
-            log.debug("boto.ec2 connection to region %s established", self.region)
-            return conn
-        except EC2ResponseError, e:
-            if e.status == '401':
-                log.error(e.message)
-                log.error("Unable to establish boto.ec2 connection. Check your aws credentials.")
-                sys.exit(1)
-            else:
-                raise
+        log.debug("boto.ec2 connection to region %s created", self.region)
+        return conn
 
     @property
     def instances(self):
@@ -107,9 +181,60 @@ class EC2Controller(object):
     def instance_filter(self):
         return { 'tag:Name': self.prefix + '-*' }
 
+    @property
+    def inventory_key(self):
+        return ','.join('{}={}'.format(k, v) for k, v in sorted(self.instance_filter.items()))
+
+    def in_inventory(self, instance):
+        """
+        whether an instance still matches our (tag) instance filter
+        """
+        if instance.state == 'terminated':
+            return False
+        for key, pattern in self.instance_filter.items():
+            if not fnmatch(instance.tags.get(key.replace('tag:', '', 1), ''), pattern):
+                return False
+        return True
+
+    def get_cached_instances(self):
+        """
+        Describe the instances listed in the cached inventory by id, which
+        is much cheaper than the tag filter search for large accounts.
+        Returns None if there's no usable inventory.
+        """
+        inventory = inventory_cache().get(self.inventory_key)
+        if not inventory:
+            return None
+
+        ids = [x['id'] for x in inventory]
+        log.debug("Fetching %d instances from cached inventory", len(ids))
+        try:
+            instances = self.connection.get_only_instances(instance_ids=ids)
+        except EC2ResponseError, e:
+            if e.error_code != 'InvalidInstanceID.NotFound':
+                raise
+            log.debug("Cached inventory is stale: %s", e.message)
+            return None
+
+        if len(instances) != len(ids) or not all(map(self.in_inventory, instances)):
+            log.debug("Cached inventory is stale")
+            return None
+        return instances
+
+    @exit_on_auth_error('ec2', EC2ResponseError, '401')
     def get_instances(self):
-        log.debug("Fetching instances using filter: %s", str(self.instance_filter))
-        instances = self.connection.get_only_instances(filters=self.instance_filter)
+        instances = None
+        if settings.EC2M_INVENTORY_TTL > 0:
+            instances = self.get_cached_instances()
+
+        if instances is None:
+            log.debug("Fetching instances using filter: %s", str(self.instance_filter))
+            instances = self.connection.get_only_instances(filters=self.instance_filter)
+            if settings.EC2M_INVENTORY_TTL > 0:
+                inventory_cache().set(self.inventory_key, [
+                    {'id': x.id, 'name': x.tags.get('Name'), 'tags': x.tags}
+                    for x in instances
+                ])
 
         for inst in instances:
             log.debug("Found: %s, %s, %s, %s, %s, monitor %s",
@@ -122,10 +247,21 @@ class EC2Controller(object):
             )
         return instances
 
-    def refresh_instances(self):
-        log.debug("Refreshing instances list")
-        for inst in self._instances:
-            inst.update()
+    def refresh_instances(self, instances=None):
+        """
+        Re-describe `instances` (default: all cluster instances) in a single
+        api call and patch the fresh state into the existing instance objects
+        """
+        if instances is None:
+            instances = self.instances
+        if not len(instances):
+            return
+        log.debug("Refreshing %d instances", len(instances))
+        by_id = dict((x.id, x) for x in instances)
+        for fresh in self.connection.get_only_instances(instance_ids=by_id.keys()):
+            by_id[fresh.id]._update(fresh)
+            if hasattr(self, '_index'):
+                self._index.update(by_id[fresh.id])
 
     def instance_tag(self, tag, default=None):
         if tag in self.admin_instance.tags:
@@ -174,23 +310,37 @@ class EC2Controller(object):
     def admin_is_up(self):
         return self.is_running(self.admin_instance)
 
+    @property
+    def index(self):
+        # rebuilt whenever the instance list itself is replaced
+        if not hasattr(self, '_index') or self._index.instances is not self.instances:
+            self._index = InstanceIndex(self.instances)
+        return self._index
+
+    def _is_mh_worker(self, instance):
+        return self.is_mh(instance) and self.is_worker(instance)
+
     @property
     def support_instances(self):
-        return filter(self.is_support, self.instances)
+        return list(self.index.role('support', self.is_support))
 
     @property
     def mh_instances(self):
-        return filter(self.is_mh, self.instances)
+        return list(self.index.role('mh', self.is_mh))
 
     @property
     def workers(self):
-        return filter(self.is_worker, self.mh_instances)
+        return list(self.index.role('workers', self._is_mh_worker))
+
+    def workers_in_state(self, state):
+        return self.index.role('workers', self._is_mh_worker, state)
 
     def get_idle_workers(self):
-        return filter(
-            lambda inst: self.is_running(inst) and self.mh.is_idle(inst),
-            self.workers
-        )
+        running = self.workers_in_state('running')
+        if not len(running):
+            return []
+        idle = self.mh.idle_map(running)
+        return filter(lambda inst: idle[inst.id], running)
 
     def instance(self, id):
         try:
@@ -206,43 +356,193 @@ class EC2Controller(object):
 
         return self._zadara
 
+    @property
+    def mh_api_url(self):
+        return 'http://' + self.admin_instance.ip_address
+
     @property
     def mh(self):
         if not hasattr(self, '_mh'):
-            mh_api_url = 'http://' + self.admin_instance.ip_address
-            self._mh = MatterhornController(mh_api_url, dry_run=self.dry_run)
-            self._mh.create_instance_host_map(self.mh_instances)
+            from matterhorn import MatterhornController
+            with self.mh_circuit():
+                mh = MatterhornController(self.mh_api_url, dry_run=self.dry_run,
+                                          deadline=self._mh_deadline)
+                mh.create_instance_host_map(self.mh_instances, cache_key=self.prefix)
+            self._mh = mh
         return self._mh
 
+    @property
+    def mh_breaker(self):
+        if not hasattr(self, '_mh_breaker'):
+            self._mh_breaker = utils.CircuitBreaker(
+                'matterhorn:' + self.prefix,
+                settings.EC2M_MH_BREAKER_THRESHOLD,
+                settings.EC2M_MH_BREAKER_COOLDOWN
+            )
+        return self._mh_breaker
+
+    _in_mh_circuit = False
+
+    @contextmanager
+    def mh_circuit(self):
+        """
+        Fail fast, without contacting matterhorn, while the cluster's
+        matterhorn circuit breaker is open, and record whether the
+        matterhorn requests made within the context worked. Only failures to
+        connect count; running out of time on a deadline doesn't mean
+        matterhorn is unreachable, just that it was slow
+        """
+        from requests.exceptions import ConnectionError
+
+        if self._in_mh_circuit:
+            # the outermost context does the accounting
+            yield
+            return
+
+        if not self.mh_breaker.allow():
+            raise MatterhornCommunicationException(
+                "Matterhorn for {} is unreachable; not retrying for up to {}s".format(
+                    self.prefix, settings.EC2M_MH_BREAKER_COOLDOWN))
+        self._in_mh_circuit = True
+        try:
+            yield
+        except (ConnectionError, MatterhornCommunicationException):
+            self.mh_breaker.record_failure()
+            raise
+        finally:
+            self._in_mh_circuit = False
+        self.mh_breaker.record_success()
+
+    _mh_deadline = None
+
+    @contextmanager
+    def mh_deadline(self, seconds):
+        """
+        Bound the matterhorn requests made within the context, including
+        connecting if that hasn't happened yet, to `seconds` in total
+        """
+        previous = self._mh_deadline
+        self._mh_deadline = utils.Deadline(seconds)
+        if hasattr(self, '_mh'):
+            self._mh.set_deadline(self._mh_deadline)
+        try:
+            yield self._mh_deadline
+        finally:
+            self._mh_deadline = previous
+            if hasattr(self, '_mh'):
+                self._mh.set_deadline(previous)
+
+    @property
+    def history(self):
+        """
+        the cluster's recorded queue depth and worker counts, or None if
+        recording is disabled
+        """
+        if not settings.EC2M_HISTORY_RETENTION:
+            return None
+        if not hasattr(self, '_history'):
+            self._history = QueueHistory(self.prefix)
+        return self._history
+
+    def record_history(self, values):
+        """
+        add a sample of `values` to the cluster's history, if enabled, and
+        return the timestamped sample
+        """
+        if self.history is None:
+            return dict(values, time=time.time())
+        return self.history.record(values)
+
+    def queue_sample(self):
+        """
+        current queue depth, running jobs and worker counts, as recorded in
+        the cluster's history
+        """
+        histogram = self.mh.queued_job_histogram()
+        return {
+            'queued_jobs': self.mh.queued_job_count(histogram=histogram),
+            'queued_high_load_jobs': self.mh.queued_job_count(
+                operation_types=settings.MAJOR_LOAD_OPERATION_TYPES,
+                histogram=histogram
+            ),
+            'running_jobs': self.mh.service_stats().running_jobs(),
+            'workers': len(self.workers),
+            'workers_online': len(self.workers_in_state('running')),
+        }
+
+    def forecast_backtest(self, window=None, horizon=None):
+        """
+        score the forecasting autoscaler against the recorded history
+        """
+        if self.history is None:
+            raise ClusterException("Queue history recording is disabled")
+        scaler = ForecastScaler(window=window, horizon=horizon)
+        return backtest(self.history.samples(), scaler)
+
+    def reset(self, rediscover=False):
+        """
+        Get a long-lived controller ready for another round of operations.
+        Connections are kept; per-run state is cleared and instance states
+        refreshed. With `rediscover` the instance list is fetched from
+        scratch on next use
+        """
+        self.instance_actions = []
+        self.wait_stats = []
+
+        if rediscover:
+            for attr in ['_instances', '_index', '_admin', '_mh']:
+                if hasattr(self, attr):
+                    delattr(self, attr)
+            return
+
+        if hasattr(self, '_instances'):
+            self.refresh_instances()
+
+        if hasattr(self, '_mh'):
+            if self._mh.client.base_url != self.mh_api_url:
+                # admin instance was restarted and has a new address
+                del self._mh
+            else:
+                self._mh.invalidate_hosts()
+
     def status_summary(self):
+        from requests.exceptions import RequestException
 
         summary = {
             'cluster': self.prefix,
-            'instances_online': len(filter(self.is_running, self.instances)),
+            'instances_online': len(self.index.in_state('running')),
             'workers': len(self.workers),
-            'workers_online': len(filter(self.is_running, self.workers)),
+            'workers_online': len(self.workers_in_state('running')),
             'instances': []
         }
 
         try:
             log.debug("Trying to fetch stats from Matterhorn")
-            with stopit.SignalTimeout(5, swallow_exc=False):
-                stats = self.mh.service_stats()
+            with self.mh_circuit():
+                with self.mh_deadline(5):
+                    stats = self.mh.service_stats()
+                    self.mh.hosts()
+                # paging through the running workflows takes a couple of
+                # requests per running operation, so it gets its own budget
+                with self.mh_deadline(settings.EC2M_MH_QUEUE_SCAN_TIMEOUT):
+                    queued = self.mh.queued_job_histogram()
                 mh_is_up = True
-        except (RequestsTimeout,
-                stopit.TimeoutException,
+        except (RequestException,
+                DeadlineExceeded,
                 MatterhornCommunicationException), e:
             log.debug("Unable to communicate with Matterhorn: %s", str(e))
             mh_is_up = False
 
         if mh_is_up:
             summary.update({
-                'queued_jobs': self.mh.queued_job_count(),
+                'queued_jobs': self.mh.queued_job_count(histogram=queued),
                 'queued_high_load_jobs': self.mh.queued_job_count(
-                    operation_types=settings.MAJOR_LOAD_OPERATION_TYPES
+                    operation_types=settings.MAJOR_LOAD_OPERATION_TYPES,
+                    histogram=queued
                 ),
                 'running_jobs': stats.running_jobs(),
             })
+            self.record_history(summary)
 
         for inst in self.instances:
             inst_summary = {
@@ -250,7 +550,7 @@ class EC2Controller(object):
                 'name': inst.tags['Name'],
                 'state': inst.state,
             }
-            if mh_is_up and self.is_mh(inst):
+            if mh_is_up and self.index.has_role('mh', self.is_mh, inst):
                 try:
                     mh_host = self.mh.get_host_for_instance(inst)
                     inst_summary['maintenance'] = mh_host.maintenance
@@ -304,6 +604,53 @@ class EC2Controller(object):
     def _stop_instance(self, instance):
         instance.stop(dry_run=self.dry_run)
 
+    def _batches(self, instances):
+        size = settings.EC2M_API_BATCH_SIZE
+        for i in range(0, len(instances), size):
+            yield instances[i:i + size]
+
+    def batch_instance_action(self, instances, action):
+        """
+        Start or stop `instances` with one api call per batch. If a batch call
+        fails the instances in it are retried individually so that failures
+        get reported (and actions recorded) per instance.
+        """
+        if action == 'started':
+            batch_func, single_func = self._start_instance_batch, self.start_instance
+        else:
+            batch_func, single_func = self._stop_instance_batch, self.stop_instance
+
+        for batch in self._batches(instances):
+            log.debug("Batch to be %s: %s", action,
+                      ', '.join("{0}, {1}, {2}".format(x.tags['Name'], x.id, x.state)
+                                for x in batch))
+            try:
+                result_ids = set(x.id for x in batch_func(batch))
+            except EC2ResponseError, e:
+                if e.error_code == 'DryRunOperation':
+                    log.info("Dry-run enabled. Instances would have been %s.", action)
+                    continue
+                log.warning("Batch request failed: %s; retrying instances individually",
+                            e.errors)
+                for inst in batch:
+                    single_func(inst)
+                continue
+
+            for inst in batch:
+                if inst.id in result_ids:
+                    self.add_instance_action(inst, action)
+                else:
+                    log.error("Instance %s missing from batch response; not %s",
+                              inst.id, action)
+
+    def _start_instance_batch(self, instances):
+        return self.connection.start_instances(
+            [x.id for x in instances], dry_run=self.dry_run)
+
+    def _stop_instance_batch(self, instances):
+        return self.connection.stop_instances(
+            [x.id for x in instances], dry_run=self.dry_run)
+
     def start_support_instances(self, wait=True):
         self.start_instances(self.support_instances, wait)
 
@@ -320,7 +667,7 @@ class EC2Controller(object):
 
             # but maybe not all of these
             workers_to_start = self.workers
-            running = filter(self.is_running, self.workers)
+            running = self.workers_in_state('running')
             workers_needed = num_workers
 
             for inst in running:
@@ -338,20 +685,19 @@ class EC2Controller(object):
         self.start_instances(instances, wait)
 
     def start_instances(self, instances, wait=True):
-        for inst in instances:
-            self.start_instance(inst)
+        self.batch_instance_action(instances, 'started')
 
         if wait:
             def running_callback(cb_instances):
-                self.refresh_instances()
+                self.refresh_instances(cb_instances)
                 running = filter(self.is_running, cb_instances)
                 return len(running) == len(cb_instances)
             log.debug("Waiting for %d instances to start...", len(instances))
             self.wait_for_state(running_callback, instances)
         else:
-            self.refresh_instances()
+            self.refresh_instances(instances)
 
-    def wait_for_state(self, state_cb, instances, success_msg=None):
+    def wait_for_state(self, state_cb, instances, success_msg=None, strategy=None):
 
         if self.dry_run:
             log.info("Dry-run enabled. Not waiting.")
@@ -360,19 +706,46 @@ class EC2Controller(object):
         if success_msg is None:
             success_msg = "Instances now in desired state"
 
-        retries = settings.EC2M_WAIT_RETRIES
-        while retries > 0:
-            if state_cb(instances):
+        if strategy is None:
+            strategy = strategy_from_settings()
+
+        stats = {
+            'callback': state_cb.__name__,
+            'polls': 0,
+            'elapsed': 0,
+            'converged': None
+        }
+        self.wait_stats.append(stats)
+
+        start = time.time()
+        deadline = start + strategy.timeout
+        intervals = strategy.intervals()
+        while True:
+            stats['polls'] += 1
+            converged = state_cb(instances)
+            stats['elapsed'] = time.time() - start
+            if converged:
+                stats['converged'] = stats['elapsed']
                 log.debug(success_msg)
+                log.debug("Wait stats: %s", stats)
                 return
-            retries -= 1
-            log.debug("Waiting for desired state... (retries remaining: %d)", retries)
-            time.sleep(settings.EC2M_WAIT_TIME)
 
+            remaining = deadline - time.time()
+            interval = next(intervals, None)
+            if interval is None or remaining <= 0:
+                break
+            interval = min(interval, remaining)
+            log.debug("Waiting for desired state... (polls: %d, next in %.1fs)",
+                      stats['polls'], interval)
+            time.sleep(interval)
+
+        log.debug("Wait stats: %s", stats)
         if self.force:
-            log.warning("Retries exceeded but 'force' enabled. Proceeding anyway.")
+            log.warning("Gave up waiting but 'force' enabled. Proceeding anyway.")
         else:
-            raise GiveUpWaitingException("Retries exceeded. Giving up.")
+            raise GiveUpWaitingException(
+                "Gave up waiting after {} polls and {:.0f}s.".format(
+                    stats['polls'], stats['elapsed']))
 
     def start_cluster(self, num_workers=None):
         log.info("Bringing up cluster")
@@ -389,7 +762,7 @@ class EC2Controller(object):
             )
 
         # but not too many running already
-        running = filter(self.is_running, self.workers)
+        running = self.workers_in_state('running')
         log.debug("Workers already running: %d", len(running))
         if len(running) > num_workers:
             raise ClusterException(
@@ -422,12 +795,15 @@ class EC2Controller(object):
         log.info("Starting MH nodes...")
         self.start_mh_instances(num_workers=num_workers)
 
+        from matterhorn import MatterhornController
+
         def api_callback(cb_instances):
-            api_url = 'http://' + self.admin_instance.ip_address
+            api_url = self.mh_api_url
             try:
-                # set a short timeout as we're polling for the api to be up
-                with stopit.SignalTimeout(5, swallow_exc=False):
-                    client = MatterhornController.client_factory(api_url)
+                # set a short deadline as we're polling for the api to be up
+                MatterhornController.client_factory(
+                    api_url, probe=True, deadline=utils.Deadline(5))
+                self.mh_breaker.record_success()
                 return True
             except Exception:
                 pass
@@ -443,8 +819,7 @@ class EC2Controller(object):
     def stop_mh_instances(self, wait=True):
 
         def idle_callback(cb_instances):
-            idle = filter(self.mh.is_idle, cb_instances)
-            return len(idle) == len(cb_instances)
+            return all(self.mh.idle_map(cb_instances).values())
 
         log.debug("Waiting for workers to be idle...")
         self.wait_for_state(idle_callback, self.workers)
@@ -456,18 +831,17 @@ class EC2Controller(object):
 
     def stop_instances(self, instances, wait=True):
 
-        for inst in instances:
-            self.stop_instance(inst)
+        self.batch_instance_action(instances, 'stopped')
 
         if wait:
             def stopped_callback(cb_instances):
-                self.refresh_instances()
+                self.refresh_instances(cb_instances)
                 stopped = filter(self.is_stopped, cb_instances)
                 return len(stopped) == len(cb_instances)
             log.debug("Waiting for %d instances to stop...", len(instances))
             self.wait_for_state(stopped_callback, instances)
         else:
-            self.refresh_instances()
+            self.refresh_instances(instances)
 
     def stop_cluster(self):
 
@@ -525,18 +899,37 @@ class EC2Controller(object):
         if self.autoscale_off:
             raise ScalingException("Autoscaling disabled for this cluster")
 
+        scaler = self.autoscaler()
+
         with self.in_maintenance(self.workers):
 
-            queued_jobs = self.mh.queued_job_count(
-                operation_types=settings.MAJOR_LOAD_OPERATION_TYPES
-            )
-            log.debug("%d queued jobs of operation type(s) %s.",
-                      queued_jobs,
-                      settings.MAJOR_LOAD_OPERATION_TYPES
+            if scaler is not None or self.history is not None:
+                sample = self.record_history(self.queue_sample())
+                too_many_queued = \
+                    sample['queued_high_load_jobs'] > settings.EC2M_MAX_QUEUED_JOBS
+            else:
+                # nothing to record, so just count until we know
+                too_many_queued = self.mh.queued_jobs_exceed(
+                    settings.EC2M_MAX_QUEUED_JOBS,
+                    operation_types=settings.MAJOR_LOAD_OPERATION_TYPES
+                )
+            log.debug("Queued jobs of operation type(s) %s %s max of %d.",
+                      settings.MAJOR_LOAD_OPERATION_TYPES,
+                      too_many_queued and "exceed" or "do not exceed",
+                      settings.EC2M_MAX_QUEUED_JOBS
                       )
-            if queued_jobs > settings.EC2M_MAX_QUEUED_JOBS:
+
+            num_workers = int(too_many_queued)
+            if scaler is not None:
+                num_workers = self.workers_to_add(sample, scaler)
+            if num_workers:
                 log.info("Attempting to scale up.")
-                self.scale_up(num_workers=1)
+                self.scale_up(num_workers=num_workers)
+                return
+            if too_many_queued:
+                # the scaler reckons the running workers can cope, but
+                # they're certainly not to be stopped
+                log.debug("No more workers needed for the queued jobs.")
                 return
 
             idle = self.get_idle_workers()
@@ -547,9 +940,43 @@ class EC2Controller(object):
                                 stop_candidates=idle)
                 return
 
+    def autoscaler(self):
+        """
+        the model sizing scale-ups for EC2M_AUTOSCALE_MODE, or None to add
+        one worker at a time
+        """
+        mode = settings.EC2M_AUTOSCALE_MODE
+        if mode == 'forecast':
+            return ForecastScaler()
+        elif mode == 'throughput':
+            return ThroughputScaler()
+        elif mode != 'threshold':
+            raise ScalingException("Unknown autoscale mode: {}".format(mode))
+
+    def workers_to_add(self, sample, scaler):
+        """
+        How many workers to start according to `scaler`, going by the
+        recorded history up to and including `sample`. Limited to the
+        workers available to start and EC2M_MAX_WORKERS, but at least one
+        if any are needed so that scale_up can complain.
+        """
+        samples = []
+        if self.history is not None:
+            samples = self.history.samples(since=sample['time'] - scaler.window)
+        if not len(samples) or samples[-1]['time'] < sample['time']:
+            samples.append(sample)
+
+        wanted = scaler.workers_to_add(samples)
+        log.debug("%s calls for %d more workers", type(scaler).__name__, wanted)
+        if not wanted:
+            return 0
+        running = len(self.workers_in_state('running'))
+        stopped = len(self.workers_in_state('stopped'))
+        return max(min(wanted, stopped, settings.EC2M_MAX_WORKERS - running), 1)
+
     def scale_to(self, num_workers):
 
-        running_workers = filter(self.is_running, self.workers)
+        running_workers = self.workers_in_state('running')
         if len(running_workers) == num_workers:
             raise ClusterException("Cluster already at {} running workers".format(num_workers))
         elif len(running_workers) > num_workers:
@@ -570,8 +997,8 @@ class EC2Controller(object):
 
     def scale_up(self, num_workers):
 
-        running = filter(self.is_running, self.workers)
-        stopped = filter(self.is_stopped, self.workers)
+        running = self.workers_in_state('running')
+        stopped = self.workers_in_state('stopped')
 
         # do we have enough non-running workers?
         if len(stopped) < num_workers:
@@ -594,7 +1021,7 @@ class EC2Controller(object):
 
     def scale_down(self, num_workers, check_uptime=False, stop_candidates=None):
 
-        running = filter(self.is_running, self.workers)
+        running = self.workers_in_state('running')
 
         # do we have that many running workers?
         if len(running) - num_workers < 0:
@@ -622,7 +1049,7 @@ class EC2Controller(object):
             if self.force:
                 log.warning(error_msg)
                 # just pick from running workers
-                stop_candidates = filter(self.is_running, self.workers)
+                stop_candidates = self.workers_in_state('running')
             else:
                 raise ScalingException(error_msg)
 
@@ -711,21 +1138,37 @@ class EC2Controller(object):
             return
 
         if instances is None:
-            instances = filter(self.is_running, self.mh_instances)
+            instances = self.index.role('mh', self.is_mh, 'running')
 
         state_str = state and "on" or "off"
 
         log.debug("Setting maintenance state for instances %s to %s",
                  ','.join(x.tags['Name'] for x in instances), state_str)
 
-        for inst in instances:
-            if state:
-                self.mh.maintenance_on(inst)
-            else:
-                self.mh.maintenance_off(inst)
+        # populate the host snapshot before fanning out so the worker
+        # threads share it rather than each fetching their own
+        self.mh.hosts()
+        toggle = state and self.mh.maintenance_on or self.mh.maintenance_off
+        results = utils.concurrent_map(
+            toggle, instances, settings.EC2M_MAINTENANCE_CONCURRENCY)
+
+        # host snapshot no longer reflects the maintenance states
+        self.mh.invalidate_hosts()
+
+        failed = [(inst, exc) for inst, result, exc in results if exc is not None]
+        for inst, exc in failed:
+            log.error("Error setting maintenance %s for %s: %s, %s",
+                      state_str, inst.id, type(exc), str(exc))
+        if len(failed):
+            raise MatterhornControllerException(
+                "Failed to set maintenance {} for {}".format(
+                    state_str, ','.join(x.id for x, exc in failed))
+            )
 
         if wait:
             def maint_callback(cb_instances):
+                # one fresh host registry fetch per poll
+                self.mh.hosts(refresh=True)
                 in_state = filter(
                     lambda inst: self.mh.is_in_maintenance(inst) == state,
                     cb_instances
@@ -5,7 +5,8 @@ __all__ = [
     'ScalingException',
     'GiveUpWaitingException',
     'MatterhornControllerException',
-    'MatterhornCommunicationException'
+    'MatterhornCommunicationException',
+    'DeadlineExceeded'
 ]
 
 class ClusterException(Exception):
@@ -23,3 +24,6 @@ class MatterhornControllerException(Exception):
 class MatterhornCommunicationException(MatterhornControllerException):
     pass
 
+class DeadlineExceeded(Exception):
+    pass
+
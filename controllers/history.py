@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+
+import json
+import math
+import time
+import logging
+from bisect import bisect_left
+
+from unipath import Path
+
+import utils
+import settings
+from exceptions import ScalingException
+
+log = logging.getLogger('ec2-manager')
+
+FIELDS = [
+    'queued_jobs',
+    'queued_high_load_jobs',
+    'running_jobs',
+    'workers',
+    'workers_online'
+]
+
+
+class QueueHistory(object):
+    """
+    A cluster's queue depth, running jobs and worker counts over time, kept
+    as a file of json lines under EC2M_CACHE_DIR/history. Samples less than
+    `min_interval` seconds after the previous one from the same object are
+    skipped, and samples older than `retention` seconds are pruned as new
+    ones come in.
+    """
+
+    def __init__(self, cluster, retention=None, min_interval=None):
+        self.path = Path(settings.EC2M_CACHE_DIR, 'history', cluster + '.jsonl')
+        if retention is None:
+            retention = settings.EC2M_HISTORY_RETENTION
+        if min_interval is None:
+            min_interval = settings.EC2M_HISTORY_MIN_INTERVAL
+        self.retention = retention
+        self.min_interval = min_interval
+        self.last_recorded = None
+
+    def record(self, values, now=None):
+        """
+        Append a sample of `values` (a dict with any of FIELDS). Returns the
+        sample, whether or not it was written.
+        """
+        if now is None:
+            now = time.time()
+        sample = dict((k, values.get(k)) for k in FIELDS)
+        sample['time'] = now
+
+        if self.last_recorded is not None and now - self.last_recorded < self.min_interval:
+            return sample
+        try:
+            # locked against other runs pruning the file
+            with utils.locked_file(self.path):
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(sample) + '\n')
+                self.last_recorded = now
+                self._prune(now)
+        except (IOError, OSError), e:
+            log.warning("Unable to record history in %s: %s", self.path, str(e))
+        return sample
+
+    def samples(self, since=None):
+        """
+        recorded samples, oldest first, optionally only those from `since`
+        """
+        samples = []
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        sample = json.loads(line)
+                    except ValueError:
+                        # partial line from an interrupted write
+                        continue
+                    if since is None or sample['time'] >= since:
+                        samples.append(sample)
+        except IOError:
+            return []
+        return sorted(samples, key=lambda x: x['time'])
+
+    def prune(self, now=None):
+        """
+        Drop expired samples. The file is only rewritten once the oldest
+        sample is a quarter of the retention period past its expiry
+        """
+        if now is None:
+            now = time.time()
+        with utils.locked_file(self.path):
+            self._prune(now)
+
+    def _prune(self, now):
+        try:
+            with open(self.path) as f:
+                oldest = json.loads(f.readline())['time']
+        except (IOError, ValueError, KeyError):
+            return
+        if now - oldest < self.retention * 1.25:
+            return
+
+        keep = self.samples(since=now - self.retention)
+
+        def write(f):
+            for sample in keep:
+                f.write(json.dumps(sample) + '\n')
+        utils.replace_file(self.path, write)
+
+
+def fit_trend(samples, field):
+    """
+    Least squares fit of `field` over time. Returns the slope (per second)
+    and the fitted value at the time of the last sample.
+    """
+    points = [(x['time'], x[field]) for x in samples if x.get(field) is not None]
+    if not len(points):
+        return 0, 0
+    if len(points) == 1:
+        return 0, points[0][1]
+
+    n = float(len(points))
+    mean_t = sum(t for t, v in points) / n
+    mean_v = sum(v for t, v in points) / n
+    variance = sum((t - mean_t) ** 2 for t, v in points)
+    if variance == 0:
+        return 0, mean_v
+    slope = sum((t - mean_t) * (v - mean_v) for t, v in points) / variance
+    return slope, mean_v + slope * (points[-1][0] - mean_t)
+
+
+class ForecastScaler(object):
+    """
+    Sizes scale-ups from the trend in queued high load jobs over the last
+    `window` seconds of history. The backlog is projected `horizon` seconds
+    ahead, roughly how long a new worker takes to come online, and a worker
+    is added for every `threshold` jobs (EC2M_MAX_QUEUED_JOBS, minimum 1)
+    by which the projection exceeds `threshold`, up to `max_step` workers.
+    """
+
+    field = 'queued_high_load_jobs'
+
+    def __init__(self, window=None, horizon=None, max_step=None, threshold=None):
+        if window is None:
+            window = settings.EC2M_FORECAST_WINDOW
+        if horizon is None:
+            horizon = settings.EC2M_FORECAST_HORIZON
+        if max_step is None:
+            max_step = settings.EC2M_FORECAST_MAX_STEP
+        if threshold is None:
+            threshold = settings.EC2M_MAX_QUEUED_JOBS
+        self.window = window
+        self.horizon = horizon
+        self.max_step = max_step
+        self.threshold = threshold
+
+    def forecast(self, samples):
+        """
+        projected backlog `horizon` seconds after the last of `samples`
+        """
+        if not len(samples):
+            return 0
+        start = samples[-1]['time'] - self.window
+        slope, level = fit_trend([x for x in samples if x['time'] >= start], self.field)
+        return max(level + slope * self.horizon, 0)
+
+    def workers_to_add(self, samples):
+        projected = self.forecast(samples)
+        log.debug("Backlog projected to be %.1f jobs in %ds", projected, self.horizon)
+        if projected <= self.threshold:
+            return 0
+        per_worker = float(max(self.threshold, 1))
+        return min(int(math.ceil((projected - self.threshold) / per_worker)), self.max_step)
+
+
+class ThroughputScaler(object):
+    """
+    Sizes scale-ups to clear the queued high load jobs in one go. Workers
+    started now only start on the backlog after `boot_time` seconds, while
+    the ones already running keep working through it, so the workers added
+    are those needed for the backlog to be gone `drain_time` seconds after
+    that. Per-worker throughput is observed from the history: the drop in the
+    backlog per online worker per second, over the intervals in the last
+    `window` seconds when it was dropping. This understates throughput while
+    jobs are still arriving, which errs towards more workers. Until there is
+    such history `default_throughput` (jobs/worker/hour) is assumed.
+    """
+
+    field = 'queued_high_load_jobs'
+
+    # ignore pairs of samples further apart than this; autoscaling wasn't
+    # running in between
+    max_gap = 900
+
+    def __init__(self, window=None, boot_time=None, drain_time=None,
+                 default_throughput=None, threshold=None):
+        if window is None:
+            window = settings.EC2M_THROUGHPUT_WINDOW
+        if boot_time is None:
+            boot_time = settings.EC2M_WORKER_BOOT_TIME
+        if drain_time is None:
+            drain_time = settings.EC2M_BACKLOG_DRAIN_TIME
+        if default_throughput is None:
+            default_throughput = settings.EC2M_WORKER_THROUGHPUT
+        if threshold is None:
+            threshold = settings.EC2M_MAX_QUEUED_JOBS
+        if drain_time <= 0 or default_throughput <= 0:
+            raise ScalingException(
+                "EC2M_BACKLOG_DRAIN_TIME and EC2M_WORKER_THROUGHPUT must be positive")
+        self.window = window
+        self.boot_time = boot_time
+        self.drain_time = drain_time
+        self.default_throughput = default_throughput
+        self.threshold = threshold
+
+    def throughput(self, samples):
+        """
+        observed jobs per worker per second, or the default if there's
+        nothing to go on
+        """
+        drained = 0
+        worker_seconds = 0
+        for prev, cur in zip(samples, samples[1:]):
+            if prev.get(self.field) is None or cur.get(self.field) is None:
+                continue
+            elapsed = cur['time'] - prev['time']
+            if not prev.get('workers_online') or elapsed > self.max_gap:
+                continue
+            if cur[self.field] < prev[self.field]:
+                drained += prev[self.field] - cur[self.field]
+                worker_seconds += elapsed * prev['workers_online']
+        if not drained:
+            return self.default_throughput / 3600.
+        return drained / float(worker_seconds)
+
+    def workers_to_add(self, samples):
+        if not len(samples):
+            return 0
+        latest = samples[-1]
+        backlog = latest.get(self.field) or 0
+        if backlog <= self.threshold:
+            return 0
+
+        running = latest.get('workers_online') or 0
+        rate = self.throughput(samples)
+        worker_seconds = backlog / rate - running * self.boot_time
+        needed = int(math.ceil(worker_seconds / float(self.drain_time)))
+        log.debug("%d queued jobs at %.2f jobs/worker/hour need %d workers",
+                  backlog, rate * 3600, needed)
+        return max(needed - running, 0)
+
+
+def backtest(samples, scaler):
+    """
+    Replay recorded `samples`, forecasting at each one from the history up to
+    that point and comparing with the backlog actually recorded `horizon`
+    seconds later. The naive forecast (no change) is scored alongside.
+    """
+    times = [x['time'] for x in samples]
+    field = scaler.field
+    forecast_errors = []
+    naive_errors = []
+    scale_ups = 0
+    workers_added = 0
+    missed = 0
+
+    for i, sample in enumerate(samples):
+        if sample.get(field) is None:
+            continue
+        later = bisect_left(times, sample['time'] + scaler.horizon)
+        if later >= len(samples) or samples[later].get(field) is None:
+            continue
+        actual = samples[later][field]
+
+        history = samples[bisect_left(times, sample['time'] - scaler.window):i + 1]
+        forecast_errors.append(abs(scaler.forecast(history) - actual))
+        naive_errors.append(abs(sample[field] - actual))
+
+        to_add = scaler.workers_to_add(history)
+        if to_add:
+            scale_ups += 1
+            workers_added += to_add
+        elif actual > scaler.threshold:
+            missed += 1
+
+    def mean(values):
+        if not len(values):
+            return None
+        return sum(values) / float(len(values))
+
+    return {
+        'samples': len(samples),
+        'points': len(forecast_errors),
+        'window': scaler.window,
+        'horizon': scaler.horizon,
+        'forecast_mae': mean(forecast_errors),
+        'naive_mae': mean(naive_errors),
+        'scale_ups': scale_ups,
+        'workers_added': workers_added,
+        'missed': missed
+    }
@@ -1,142 +1,389 @@
 # -*- coding: utf-8 -*-
 
 import pyhorn
-# this is a hack until pyhorn can get it's caching controls sorted out
-pyhorn.client._session._is_cache_disabled = True
-
+import time
 import logging
-from requests.exceptions import Timeout as RequestsTimeout
+from urlparse import urlparse
+from requests.exceptions import RequestException, Timeout as RequestsTimeout
 
+import utils
 import settings
 from exceptions import *
 
 log = logging.getLogger('ec2-manager')
 
+def session_cache():
+    return utils.FileCache('mh_sessions', ttl=settings.EC2M_MH_SESSION_TTL)
+
+def host_map_cache():
+    return utils.FileCache('mh_host_maps', ttl=settings.EC2M_MH_HOST_MAP_TTL)
+
+def normalize_address(address):
+    """
+    reduce a host url or bare hostname/ip to a lowercased hostname, dropping
+    any scheme, port and path
+    """
+    if '//' not in address:
+        address = '//' + address
+    return urlparse(address).hostname or ''
+
+def _save_session_hook(resp, *args, **kwargs):
+    # keep the cached session current if the server hands out a new one
+    if 'set-cookie' in resp.headers:
+        url = urlparse(resp.url)
+        MatterhornController.save_session(url.scheme + '://' + url.netloc)
+
+def configure_pyhorn():
+    """
+    adjust pyhorn's shared session; done on first use of a client rather
+    than at import
+    """
+    session = pyhorn.client._session
+    # this is a hack until pyhorn can get it's caching controls sorted out
+    session._is_cache_disabled = True
+    if _save_session_hook not in session.hooks['response']:
+        session.hooks['response'].append(_save_session_hook)
+
+class MHClient(pyhorn.MHClient):
+    """
+    pyhorn client whose request timeouts are capped by the time remaining
+    before its `deadline`, if it has one
+    """
+
+    deadline = None
+
+    @property
+    def timeout(self):
+        if self.deadline is None:
+            return self._timeout
+        return self.deadline.timeout(float(self._timeout))
+
+    @timeout.setter
+    def timeout(self, value):
+        self._timeout = value
+
+
 class MatterhornController():
 
     @classmethod
-    def client_factory(cls, api_url):
-        client = pyhorn.MHClient(api_url,
-                                 user=settings.MATTERHORN_ADMIN_SERVER_USER,
-                                 passwd=settings.MATTERHORN_ADMIN_SERVER_PASS,
-                                 timeout=settings.PYHORN_TIMEOUT
-                                 )
+    def load_session(cls, api_url):
+        """
+        Put any cached session cookies for `api_url` in pyhorn's session
+        so requests skip the digest auth handshake
+        """
+        cookies = session_cache().get(api_url)
+        if not cookies:
+            return False
+        for c in cookies:
+            pyhorn.client._session.cookies.set(
+                c['name'], c['value'], domain=c['domain'], path=c['path'])
+        return True
+
+    @classmethod
+    def save_session(cls, api_url):
+        host = urlparse(api_url).hostname
+        cookies = [
+            {'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path}
+            for c in pyhorn.client._session.cookies
+            if c.domain.lstrip('.') == host
+        ]
+        if len(cookies):
+            session_cache().set(api_url, cookies)
+
+    @classmethod
+    def forget_session(cls, api_url):
+        session_cache().delete(api_url)
+
+    @classmethod
+    def client_factory(cls, api_url, probe=False, deadline=None):
+        """
+        Returns a pyhorn client for `api_url`. The connection is verified
+        with a `me()` request unless a cached session exists for the api_url
+        and `probe` is not requested. Requests made by the client are
+        bounded by the `deadline` (a utils.Deadline) if one is given
+        """
+        configure_pyhorn()
+        client = MHClient(api_url,
+                          user=settings.MATTERHORN_ADMIN_SERVER_USER,
+                          passwd=settings.MATTERHORN_ADMIN_SERVER_PASS,
+                          timeout=settings.PYHORN_TIMEOUT
+                          )
+        client.deadline = deadline
+        if not probe and cls.load_session(api_url):
+            log.debug("reusing cached session for %s", api_url)
+            return client
+
         try:
             log.debug("verifying pyhorn client connection")
             assert client.me() is not None
+            cls.save_session(api_url)
             return client
         except Exception, e:
             # this could be anything: communication problem, unexpected response, etc
             log.debug("pyhorn client failed to connect")
+            cls.forget_session(api_url)
             raise MatterhornCommunicationException(
                 "Error connecting to Matterhorn API at {}: {}".format(
                     api_url, str(e)
                 )
             )
 
-    def __init__(self, api_url, dry_run=False):
+    def __init__(self, api_url, dry_run=False, deadline=None):
         self.dry_run = dry_run
         self.instance_host_map = {}
-        self.client = MatterhornController.client_factory(api_url)
+        self._hosts = None
+        self._hosts_fetched = None
+        self.client = MatterhornController.client_factory(api_url, deadline=deadline)
 
-    def create_instance_host_map(self, instances):
-        hosts = dict((x.base_url, x) for x in self.client.hosts())
+    def set_deadline(self, deadline):
+        """
+        bound subsequent requests by `deadline`, or not at all if None
+        """
+        self.client.deadline = deadline
+
+    def hosts(self, refresh=False):
+        """
+        Snapshot of the Matterhorn host registry, keyed by base_url. The
+        snapshot is shared by all the per-instance lookups and only refetched
+        when it's older than EC2M_MH_HOSTS_TTL or `refresh` is requested
+        """
+        if refresh or self._hosts is None \
+                or time.time() - self._hosts_fetched > settings.EC2M_MH_HOSTS_TTL:
+            log.debug("Fetching Matterhorn host registry")
+            try:
+                hosts = self.client.hosts()
+            except (RequestException, pyhorn.MHClientHTTPError), e:
+                # as with service_stats, this may be the first request made
+                # with a cached session
+                MatterhornController.forget_session(self.client.base_url)
+                raise MatterhornCommunicationException(
+                    "Error fetching hosts from {}: {}".format(self.client.base_url, str(e))
+                )
+            self._hosts = dict((x.base_url, x) for x in hosts)
+            self._hosts_fetched = time.time()
+        return self._hosts
 
-        def find_host_url(inst):
-            candidate_hosts = [
+    def invalidate_hosts(self):
+        self._hosts = None
+
+    def host_address_index(self):
+        """
+        normalized hostname/ip -> host urls registered for it, with http
+        urls ahead of https
+        """
+        index = {}
+        for url in sorted(self.hosts().keys(), key=lambda x: x.startswith('https')):
+            index.setdefault(normalize_address(url), []).append(url)
+        return index
+
+    def create_instance_host_map(self, instances, cache_key=None):
+        """
+        Work out which Matterhorn host url belongs to each of `instances`. If
+        a `cache_key` is given the mapping is saved and reused by later
+        processes for as long as the instances' addresses stay the same.
+        """
+        addresses = dict(
+            (inst.id, [normalize_address(x or '') for x in [
                 inst.private_ip_address,
                 inst.public_dns_name,
                 inst.private_dns_name
-            ]
-            host_url = None
-            for h in candidate_hosts:
-                for scheme in ['http','https']:
-                    candidate_url = scheme + '://' + h
-                    if candidate_url in hosts:
-                        host_url = candidate_url
-                        del hosts[host_url]
-            # returns the last one found
-            # is assumption correct to prefer https?
-            return host_url
+            ]])
+            for inst in instances
+        )
+
+        if cache_key is not None and settings.EC2M_MH_HOST_MAP_TTL > 0:
+            cached = host_map_cache().get(cache_key)
+            if cached and cached['api_url'] == self.client.base_url \
+                    and cached['addresses'] == addresses:
+                log.debug("Using cached instance <-> mh host map for %s", cache_key)
+                self.instance_host_map.update(cached['host_map'])
+                return
+
+        index = self.host_address_index()
+        unmatched_hosts = set(self.hosts().keys())
+        unmapped = []
 
         for inst in instances:
-            url = find_host_url(inst)
-            if url is not None:
+            # later candidates (and https urls) take precedence
+            matches = [url for addr in addresses[inst.id]
+                       for url in index.get(addr, [])
+                       if url in unmatched_hosts]
+            if len(matches):
+                url = matches[-1]
+                unmatched_hosts.difference_update(matches)
                 log.debug("Mapping %s to Matterhorn host url %s", inst.id, url)
                 self.instance_host_map[inst.id] = url
             else:
                 log.debug("Failed to find host url for %s", inst.id)
+                unmapped.append(inst)
 
         # check if we missed any hosts (e.g., the engage node usually)
-        unmapped = [x for x in instances if x.id not in self.instance_host_map]
-        if len(hosts) != len(unmapped) or len(hosts) > 1 or len(unmapped) > 1:
+        if len(unmatched_hosts) != len(unmapped) or len(unmatched_hosts) > 1 or len(unmapped) > 1:
             # maybe trouble
             log.warn(
                 "Unmappable instances <-> mh hosts!: instances: {}, mh hosts: {}".format(
                     ','.join(x.tags['Name'] for x in unmapped),
-                    ','.join(x for x in hosts.keys())
+                    ','.join(x for x in unmatched_hosts)
                 )
             )
-        elif len(hosts) == len(unmapped) == 1:
+        elif len(unmatched_hosts) == len(unmapped) == 1:
             # NOTE: this makes a pretty ugly assumption but there's currently no
             # other alternative for associating the engage instance with it's
             # mh node since the engage node's 'host_url' value doesn't
             # always correspond to an ip/dns name attributes of the aws instance
-            log.debug("Assuming host url for %s is %s", unmapped[0].id, hosts.keys()[0])
-            self.instance_host_map[unmapped[0].id] = hosts.keys()[0]
+            host_url = next(iter(unmatched_hosts))
+            log.debug("Assuming host url for %s is %s", unmapped[0].id, host_url)
+            self.instance_host_map[unmapped[0].id] = host_url
+
+        if cache_key is not None and settings.EC2M_MH_HOST_MAP_TTL > 0:
+            host_map_cache().set(cache_key, {
+                'api_url': self.client.base_url,
+                'addresses': addresses,
+                'host_map': dict((x.id, self.instance_host_map[x.id])
+                                 for x in instances if x.id in self.instance_host_map)
+            })
 
     def service_stats(self):
-        return self.client.statistics()
+        try:
+            return self.client.statistics()
+        except (RequestException, pyhorn.MHClientHTTPError), e:
+            # the connection check may have been skipped in favor of a cached
+            # session, so this could be our first contact with the server
+            MatterhornController.forget_session(self.client.base_url)
+            raise MatterhornCommunicationException(
+                "Error fetching stats from {}: {}".format(self.client.base_url, str(e))
+            )
 
-    def queued_job_count(self, operation_types=None):
+    def running_workflows(self, page_size=None):
+        """
+        Generator over the running workflows. Fetches a page at a time so
+        callers that stop iterating early never request the rest
+        """
+        if page_size is None:
+            page_size = settings.EC2M_MH_WORKFLOW_PAGE_SIZE
 
-        # get the running workflows; high "count" value to make sure we get all
-        running_wfs = self.client.workflows(state="RUNNING", count=1000)
+        def fetch(page):
+            log.debug("Fetching page %d of running workflows", page)
+            return self.client.workflows(state="RUNNING", count=page_size, startPage=page)
 
-        # then get their running operations
-        running_ops = []
-        for wf in running_wfs:
-            running_ops.extend(filter(
-                lambda x: x.state in ["RUNNING","WAITING"],
-                wf.operations
-            ))
+        # The list can change between page fetches. Workflows finishing on
+        # pages already fetched shift the later ones toward the front, so
+        # some cross back over the boundary into the page before the one
+        # fetched next and would be skipped; re-reading the previous page
+        # after each new one picks those up. New workflows shift things the
+        # other way, so some turn up twice and are dropped here. One can
+        # still be missed if enough finish between two requests to push it
+        # back more than a page.
+        seen = set()
 
-        # filter for the operation types we're interested in
-        if operation_types is not None:
-            running_ops = filter(lambda x: x.id in operation_types, running_ops)
+        def unseen(wfs):
+            for wf in wfs:
+                if wf.id not in seen:
+                    seen.add(wf.id)
+                    yield wf
 
-        # now get any queued child jobs of those operations
-        queued_jobs = []
-        for op in running_ops:
-            queued_jobs.extend(filter(lambda x: x.status == "QUEUED", op.job.children))
+        page = 0
+        while True:
+            wfs = fetch(page)
+            for wf in unseen(wfs):
+                yield wf
+            if page > 0:
+                for wf in unseen(fetch(page - 1)):
+                    yield wf
+            if len(wfs) < page_size:
+                return
+            page += 1
 
-        return len(queued_jobs)
+    def queued_jobs_by_operation(self):
+        """
+        Generator of (operation type, queued child job count) for each
+        running operation of the running workflows
+        """
+        for wf in self.running_workflows():
+            for op in wf.operations:
+                if op.state not in ["RUNNING", "WAITING"]:
+                    continue
+                queued = len(filter(lambda x: x.status == "QUEUED", op.job.children))
+                if queued:
+                    yield op.id, queued
 
-    def is_idle(self, inst):
-        host_url = self.instance_host_map[inst.id]
-        log.debug("Checking idleness state of %s, %s", inst.id, host_url)
+    def queued_job_histogram(self):
+        """
+        Number of queued child jobs of the running workflow operations, keyed
+        by operation type, from a single pass over the running workflows
+        """
+        histogram = {}
+        for op_type, queued in self.queued_jobs_by_operation():
+            histogram[op_type] = histogram.get(op_type, 0) + queued
+        return histogram
+
+    def queued_job_count(self, operation_types=None, histogram=None):
+        """
+        Total queued jobs, optionally limited to `operation_types`. Pass in
+        a `histogram` from queued_job_histogram() to avoid refetching the
+        workflows when computing several counts
+        """
+        if histogram is None:
+            histogram = self.queued_job_histogram()
+
+        if operation_types is None:
+            return sum(histogram.values())
+        return sum(histogram.get(x, 0) for x in set(operation_types))
+
+    def queued_jobs_exceed(self, threshold, operation_types=None):
+        """
+        Whether more than `threshold` jobs (optionally only of
+        `operation_types`) are queued. Stops walking the workflows as soon
+        as the threshold is crossed
+        """
+        total = 0
+        for op_type, queued in self.queued_jobs_by_operation():
+            if operation_types is not None and op_type not in operation_types:
+                continue
+            total += queued
+            if total > threshold:
+                return True
+        return False
+
+    def idle_map(self, instances):
+        """
+        Idleness state of each instance, keyed by instance id, from a single
+        fetch of the service statistics
+        """
+        log.debug("Checking idleness state of %s", ','.join(str(x.id) for x in instances))
         try:
             stats = self.client.statistics()
         except RequestsTimeout, e:
-            log.warning("Idleness state check for %s failed: %s, %s",
-                        inst.id, type(e), str(e))
-            return False
-        running_jobs = stats.running_jobs(host=host_url)
-        log.debug("%s has %d running jobs", host_url, running_jobs)
-        return running_jobs == 0
+            log.warning("Idleness state check failed: %s, %s", type(e), str(e))
+            return dict((x.id, False) for x in instances)
+
+        running = {}
+        for service in stats.services:
+            host = service.registration.host
+            running[host] = running.get(host, 0) + int(service.running)
+
+        idle = {}
+        for inst in instances:
+            host_url = self.instance_host_map[inst.id]
+            running_jobs = running.get(host_url, 0)
+            log.debug("%s has %d running jobs", host_url, running_jobs)
+            idle[inst.id] = running_jobs == 0
+        return idle
 
-    def get_host_for_instance(self, inst):
-        host_objs = self.client.hosts()
+    def is_idle(self, inst):
+        return self.idle_map([inst])[inst.id]
+
+    def get_host_for_instance(self, inst, refresh=False):
         try:
             host_url = self.instance_host_map[inst.id]
-            return next(x for x in host_objs if x.base_url == host_url)
-        except (KeyError, StopIteration):
+            return self.hosts(refresh)[host_url]
+        except KeyError:
             raise MatterhornControllerException(
                 "No Matterhorn host mappted to {}".format(inst.id)
             )
 
-    def is_in_maintenance(self, inst):
-        host = self.get_host_for_instance(inst)
+    def is_in_maintenance(self, inst, refresh=False):
+        host = self.get_host_for_instance(inst, refresh)
         return host.maintenance
 
     def maintenance_off(self, inst):
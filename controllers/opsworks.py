@@ -1,14 +1,17 @@
-import sys
-
-import boto.opsworks
 from boto.exception import JSONResponseError
 
-from ec2 import EC2Controller, EC2Instance
+import utils
+import settings
+from ec2 import EC2Controller, EC2Instance, exit_on_auth_error
 from exceptions import *
 
 import logging
 log = logging.getLogger()
 
+def stack_id_cache():
+    return utils.FileCache('opsworks_stacks', ttl=settings.EC2M_STACK_ID_TTL)
+
+
 class OpsworksEC2Instance(EC2Instance):
 
     opsworks_instance = None
@@ -28,32 +31,54 @@ class OpsworksController(EC2Controller):
 
     def create_opsworks_conn(self):
 
+        # credentials get checked by the first real api call; see stack
+        import boto.opsworks
         conn = boto.opsworks.connect_to_region(self.region, **self.aws_connect_params)
-
-        try:
-            conn.describe_stacks()
-            log.debug("boto.opsworks connection to region %s established", self.region)
-            return conn
-        except JSONResponseError, e:
-            if e.status == '400':
-                log.error(e.message)
-                log.error("Unable to establish boto.opsworks connection. Check your aws credentials.")
-                sys.exit(1)
-            else:
-                raise
+        log.debug("boto.opsworks connection to region %s created", self.region)
+        return conn
 
     @property
+    @exit_on_auth_error('opsworks', JSONResponseError, '400')
     def stack(self):
         if not hasattr(self, '_stack'):
-            stacks = self.opsworks.describe_stacks()
-            try:
-                self._stack = next(x for x in stacks['Stacks'] if x['Name'] == self.prefix)
-            except StopIteration:
-               raise ClusterException(
-                   "Can't find a stack named {}".format(self.prefix)
-               )
+            stack = None
+            if settings.EC2M_STACK_ID_TTL > 0:
+                stack = self.get_cached_stack()
+
+            if stack is None:
+                log.debug("Searching all stacks for %s", self.prefix)
+                stacks = self.opsworks.describe_stacks()
+                try:
+                    stack = next(x for x in stacks['Stacks'] if x['Name'] == self.prefix)
+                except StopIteration:
+                   raise ClusterException(
+                       "Can't find a stack named {}".format(self.prefix)
+                   )
+                if settings.EC2M_STACK_ID_TTL > 0:
+                    stack_id_cache().set(self.prefix, stack['StackId'])
+            self._stack = stack
         return self._stack
 
+    def get_cached_stack(self):
+        """
+        Describe just our stack if its id is known from a previous run.
+        Returns None if there's no cached id or it's no longer valid.
+        """
+        stack_id = stack_id_cache().get(self.prefix)
+        if stack_id is None:
+            return None
+        try:
+            stacks = self.opsworks.describe_stacks(stack_ids=[stack_id])['Stacks']
+        except JSONResponseError, e:
+            if e.error_code != 'ResourceNotFoundException':
+                raise
+            stacks = []
+        if len(stacks) != 1 or stacks[0]['Name'] != self.prefix:
+            log.debug("Cached stack id %s for %s is stale", stack_id, self.prefix)
+            stack_id_cache().delete(self.prefix)
+            return None
+        return stacks[0]
+
     @property
     def instances(self):
         if not hasattr(self, '_instances'):
@@ -64,24 +89,30 @@ class OpsworksController(EC2Controller):
             )
 
             opsworks_instances = self.opsworks.describe_instances(self.stack['StackId'])['Instances']
-            self._instances = []
+            by_ec2_id = dict((x['Ec2InstanceId'], x) for x in opsworks_instances
+                             if 'Ec2InstanceId' in x)
 
+            instances = []
+            missing = []
+            autoscaled = []
             for ec2_inst in ec2_instances:
-                try:
-                    ops_inst = next(x for x in opsworks_instances if x['Ec2InstanceId'] == ec2_inst.id)
-                except StopIteration:
-                    raise ClusterException(
-                        "Cannot find matching opsworks instance for {}".format(ec2_inst.id)
-                    )
+                ops_inst = by_ec2_id.get(ec2_inst.id)
+                if ops_inst is None:
+                    missing.append(ec2_inst.id)
+                # ignore non "24/7" opsworks instances (i.e. timer/load autoscale intances)
+                elif 'AutoScalingType' in ops_inst:
+                    autoscaled.append(ops_inst['InstanceId'])
                 else:
-                    log.debug("Found matching opsworks instance %s", ops_inst['InstanceId'])
+                    instances.append(OpsworksEC2Instance(ec2_inst, ops_inst))
 
-                    # ignore non "24/7" opsworks instances (i.e. timer/load autoscale intances)
-                    if 'AutoScalingType' in ops_inst:
-                        log.debug("ignoring opsworks autoscale instance %s", ops_inst['InstanceId'])
-                        continue
-
-                    self._instances.append(OpsworksEC2Instance(ec2_inst, ops_inst))
+            if len(missing):
+                raise ClusterException(
+                    "Cannot find matching opsworks instances for {}".format(', '.join(map(str, missing)))
+                )
+            if len(autoscaled):
+                log.debug("ignoring opsworks autoscale instances %s", ', '.join(autoscaled))
+            log.debug("Found %d matching opsworks instances", len(instances))
+            self._instances = instances
 
         return self._instances
 
@@ -115,6 +146,19 @@ class OpsworksController(EC2Controller):
             log.info("If this wasn't a dry run, would be stopping %s, %s", opsworks_id, instance.id)
         self.opsworks.stop_instance(opsworks_id)
 
+    def batch_instance_action(self, instances, action):
+        """
+        opsworks has no batch start/stop, so this is one call per instance,
+        each recorded as it's made so that if one fails the ones before it
+        are still reported
+        """
+        if action == 'started':
+            single_func = self.start_instance
+        else:
+            single_func = self.stop_instance
+        for inst in instances:
+            single_func(inst)
+
     def _not_implemented(self, *args, **kwargs):
         raise NotImplementedError(
             "This operation is not implemented for opsworks clusters"
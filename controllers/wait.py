@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import random
+
+import settings
+
+
+class FixedInterval(object):
+    """
+    Poll up to `retries` times, sleeping `interval` seconds in between
+    """
+
+    def __init__(self, interval, retries):
+        self.interval = interval
+        self.retries = retries
+        self.timeout = interval * retries
+
+    def intervals(self):
+        for i in range(self.retries - 1):
+            yield self.interval
+
+
+class ExponentialBackoff(object):
+    """
+    Start polling quickly and back off exponentially (with some jitter) up to
+    `maximum` seconds between polls, giving up once `timeout` seconds have
+    passed
+    """
+
+    def __init__(self, initial, maximum, timeout, factor=2, jitter=0.2):
+        self.initial = initial
+        self.maximum = maximum
+        self.timeout = timeout
+        self.factor = factor
+        self.jitter = jitter
+
+    def intervals(self):
+        interval = self.initial
+        while True:
+            yield interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+            interval = min(interval * self.factor, self.maximum)
+
+
+def strategy_from_settings():
+    if settings.EC2M_WAIT_STRATEGY == 'fixed':
+        return FixedInterval(settings.EC2M_WAIT_TIME, settings.EC2M_WAIT_RETRIES)
+    return ExponentialBackoff(settings.EC2M_WAIT_INITIAL,
+                              settings.EC2M_WAIT_MAX_INTERVAL,
+                              settings.EC2M_WAIT_TIMEOUT)
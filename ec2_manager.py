@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import sys
+import json
 import logging
 from functools import wraps
 
@@ -9,9 +10,9 @@ click.disable_unicode_literals_warning = True
 
 import utils
 import settings
-from controllers import ec2, ClusterException, \
-    EC2Controller, \
-    OpsworksController
+from controllers import ec2
+from controllers.ec2 import EC2Controller
+from controllers.exceptions import ClusterException
 
 log = logging.getLogger('ec2-manager')
 
@@ -49,6 +50,7 @@ def cli(ctx, prefix, verbose, debug, dry_run, force, opsworks):
         log.info("Dry run enabled!")
 
     if opsworks:
+        from controllers.opsworks import OpsworksController
         cluster = OpsworksController(prefix, force=force, dry_run=dry_run)
         ctx.meta['opsworks'] = True
     else:
@@ -121,6 +123,17 @@ def scale(cluster, direction, workers):
     """Incrementally scale a cluster up/down a specified number of workers"""
     cluster.scale(direction, num_workers=workers)
 
+@cli.command()
+@click.option('--window', type=int, help="seconds of history to fit")
+@click.option('--horizon', type=int, help="seconds ahead to forecast")
+@click.pass_obj
+@handle_exit
+def backtest(cluster, window, horizon):
+    """Score the forecasting autoscaler against a cluster's recorded queue
+    history"""
+    result = cluster.forecast_backtest(window=window, horizon=horizon)
+    click.echo(json.dumps(result, indent=2))
+
 @cli.command()
 @click.argument('state', type=click.Choice(['on', 'off']))
 @click.pass_obj
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+import sys
+import time
+import signal
+import logging
+
+import click
+click.disable_unicode_literals_warning = True
+
+import utils
+import settings
+from controllers.ec2 import EC2Controller
+from controllers.exceptions import ClusterException, \
+    MatterhornControllerException
+
+log = logging.getLogger('ec2-manager')
+
+def parse_clusters(clusters, default_interval):
+    """
+    turn 'prefix[:seconds]' args into a dict of prefix -> interval
+    """
+    intervals = {}
+    for arg in clusters:
+        prefix, _, interval = arg.partition(':')
+        try:
+            intervals[prefix] = interval and int(interval) or default_interval
+        except ValueError:
+            raise click.BadParameter("Invalid interval for {}".format(arg))
+    return intervals
+
+
+class AutoscaleDaemon(object):
+    """
+    Runs autoscale cycles for a set of clusters from a single process. Each
+    cluster's controller (and so its aws & matterhorn connections) is kept
+    between cycles and only reset, rather than rebuilt, before each one.
+    """
+
+    def __init__(self, intervals, controller_class=EC2Controller,
+                 dry_run=False, force=False):
+        self.intervals = intervals
+        self.controller_class = controller_class
+        self.dry_run = dry_run
+        self.force = force
+
+        self.controllers = {}
+        self.discovered = {}
+        self.next_run = dict((prefix, 0) for prefix in intervals)
+
+    def controller(self, prefix):
+        if prefix not in self.controllers:
+            self.controllers[prefix] = self.controller_class(
+                prefix, dry_run=self.dry_run, force=self.force)
+            self.discovered[prefix] = time.time()
+        else:
+            cluster = self.controllers[prefix]
+            rediscover = time.time() - self.discovered[prefix] \
+                > settings.EC2M_DAEMON_REDISCOVER_INTERVAL
+            if rediscover:
+                log.debug("Rediscovering instances for %s", prefix)
+                self.discovered[prefix] = time.time()
+            cluster.reset(rediscover=rediscover)
+        return self.controllers[prefix]
+
+    def run_cycle(self, prefix):
+        log.debug("Starting autoscale cycle for %s", prefix)
+        try:
+            cluster = self.controller(prefix)
+            if not cluster.admin_is_up():
+                log.info("%s: admin instance is not running; skipping", prefix)
+                return
+            cluster.autoscale()
+        except ClusterException, e:
+            log.info("%s: %s", prefix, str(e))
+        except MatterhornControllerException, e:
+            log.warning("%s: matterhorn error: %s", prefix, str(e))
+            # start over with a fresh matterhorn client next cycle
+            if prefix in self.controllers:
+                self.controllers[prefix].reset(rediscover=True)
+        except Exception, e:
+            log.exception("%s: autoscale cycle failed: %s", prefix, str(e))
+        else:
+            utils.log_action_summary(cluster.action_summary())
+
+    def run(self, max_cycles=None):
+        cycles = 0
+        while max_cycles is None or cycles < max_cycles:
+            prefix = min(self.next_run, key=self.next_run.get)
+            delay = self.next_run[prefix] - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.run_cycle(prefix)
+            self.next_run[prefix] = time.time() + self.intervals[prefix]
+            cycles += 1
+
+
+def status_sweep(prefixes, controller_class=EC2Controller):
+    """
+    Collect the status summaries of several clusters concurrently, so that a
+    sweep takes about as long as the slowest cluster
+    """
+    def summarize(prefix):
+        return controller_class(prefix).status_summary()
+
+    summaries = []
+    results = utils.concurrent_map(summarize, list(prefixes),
+                                   settings.EC2M_STATUS_CONCURRENCY)
+    for prefix, summary, exc in results:
+        if exc is not None:
+            log.warning("Unable to get status of %s: %s", prefix, str(exc))
+            summary = {'cluster': prefix, 'error': str(exc)}
+        summaries.append(summary)
+    return {'clusters': summaries}
+
+
+@click.group()
+@click.option('-v/-q','--verbose/--quiet', is_flag=True, default=True)
+@click.option('-d','--debug', is_flag=True)
+@click.option('-n','--dry-run', is_flag=True)
+@click.option('-f', '--force', is_flag=True)
+@click.option('-o', '--opsworks', is_flag=True)
+@click.version_option(settings.VERSION)
+@click.pass_context
+def cli(ctx, verbose, debug, dry_run, force, opsworks):
+
+    log_level = debug and logging.DEBUG or logging.INFO
+    utils.init_logging('multi', verbose, log_level)
+    log.debug("Command: %s %s, options: %s",
+              ctx.info_name, ctx.invoked_subcommand, ctx.params)
+    if dry_run:
+        log.info("Dry run enabled!")
+
+    controller_class = EC2Controller
+    if opsworks:
+        from controllers.opsworks import OpsworksController
+        controller_class = OpsworksController
+
+    ctx.obj = {
+        'controller_class': controller_class,
+        'dry_run': dry_run,
+        'force': force
+    }
+
+@cli.command()
+@click.argument('clusters', nargs=-1, required=True)
+@click.option('-i', '--interval', type=int,
+              default=settings.EC2M_DAEMON_INTERVAL)
+@click.pass_obj
+def daemon(opts, clusters, interval):
+    """Continuously autoscale one or more clusters. A cluster can be given its
+    own schedule with PREFIX:SECONDS"""
+
+    intervals = parse_clusters(clusters, interval)
+    log.info("Autoscaling %s", ', '.join(
+        "{} every {}s".format(k, v) for k, v in sorted(intervals.items())))
+
+    # exit cleanly when stopped by a process supervisor
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    AutoscaleDaemon(intervals, **opts).run()
+
+@cli.command()
+@click.argument('clusters', nargs=-1, required=True)
+@click.option('-f','--format', default='json', type=click.Choice(['json', 'table']))
+@click.pass_obj
+def status(opts, clusters, format):
+    """Output the combined service job/queue status of several clusters"""
+    stats = status_sweep(clusters, opts['controller_class'])
+    click.echo(utils.format_status(stats, format))
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,89 @@
+import sys
+import Queue
+import logging
+import threading
+import requests
+from urllib import quote
+from requests.exceptions import RequestException
+from pythonjsonlogger import jsonlogger
+from pyloggly.handler import DEFAULT_MESSAGE_FORMAT
+
+import settings
+
+BULK_URL_FORMAT = "https://{host}/bulk/{token}/tag/{tags}"
+
+class BulkLogglyHandler(logging.Handler):
+    """
+    Ships log records to loggly's bulk endpoint from a background thread so
+    logging calls never wait on the network. Formatted records are buffered
+    in a bounded queue and posted in batches of up to `batch_size`. If the
+    buffer fills up new records are dropped (and counted) rather than
+    blocking the caller. Closing the handler, which logging does at exit,
+    sends whatever is still buffered.
+    """
+
+    _closed = object()
+
+    def __init__(self, token, host, tags=None, batch_size=None, buffer_size=None):
+        # pyloggly's LogglyHandler would set up a FuturesSession and thread
+        # pool of its own, so only its message format is borrowed
+        logging.Handler.__init__(self)
+        self.url = BULK_URL_FORMAT.format(
+            host=host,
+            token=token,
+            tags=quote(tags or 'pyloggly', safe=',')
+        )
+        self.setFormatter(jsonlogger.JsonFormatter(DEFAULT_MESSAGE_FORMAT))
+        self.batch_size = batch_size or settings.LOGGLY_BATCH_SIZE
+        self.queue = Queue.Queue(buffer_size or settings.LOGGLY_BUFFER_SIZE)
+        self.dropped = 0
+        self.failed = 0
+        self.worker = threading.Thread(target=self._ship, name='loggly')
+        self.worker.daemon = True
+        self.worker.start()
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.format(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _ship(self):
+        session = requests.Session()
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size and batch[-1] is not self._closed:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            done = batch[-1] is self._closed
+            if done:
+                batch.pop()
+            if len(batch):
+                self._post(session, batch)
+            if done:
+                return
+
+    def _post(self, session, batch):
+        try:
+            session.post(self.url, data='\n'.join(batch),
+                         timeout=settings.EC2M_HTTP_TIMEOUT)
+        except RequestException:
+            # nowhere to report this without logging (and so shipping) again
+            self.failed += len(batch)
+
+    def close(self):
+        if self.worker.is_alive():
+            try:
+                self.queue.put(self._closed, timeout=settings.LOGGLY_FLUSH_TIMEOUT)
+                self.worker.join(settings.LOGGLY_FLUSH_TIMEOUT)
+            except Queue.Full:
+                pass
+        if self.dropped or self.failed:
+            sys.stderr.write("loggly: {} log records dropped, {} failed to send\n".format(
+                self.dropped, self.failed))
+            self.dropped = self.failed = 0
+        logging.Handler.close(self)
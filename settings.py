@@ -10,11 +10,19 @@ dotenv.load_dotenv(Path(__file__).parent.child('.env'))
 
 VERSION = '2.3.3'
 
+# where data kept between runs (sessions, inventories, etc) is stored
+EC2M_CACHE_DIR = env('EC2M_CACHE_DIR', Path(__file__).parent.child('cache'))
+
 # Matterhorn credentials and http bits
 MATTERHORN_HEADERS     = { 'X-REQUESTED-AUTH' : 'Digest', 'X-Opencast-Matterhorn-Authorization' : 'true' }
 MATTERHORN_REALM       = 'Opencast Matterhorn'
 MATTERHORN_ADMIN_SERVER_USER = env('MATTERHORN_ADMIN_SERVER_USER')
 MATTERHORN_ADMIN_SERVER_PASS = env('MATTERHORN_ADMIN_SERVER_PASS')
+# how long (seconds) a matterhorn session cookie is reused across runs
+EC2M_MH_SESSION_TTL = int(env('EC2M_MH_SESSION_TTL', 3600))
+
+# timeout (seconds) for requests made via utils.http_request
+EC2M_HTTP_TIMEOUT = float(env('EC2M_HTTP_TIMEOUT', 2))
 
 NON_MH_SUFFIXES = ["-nfs", "-db", "-mysql"]
 MH_SUFFIXES = ["-admin", "-worker", "-engage"]
@@ -28,8 +36,84 @@ EC2M_MAX_QUEUED_JOBS = int(env('EC2M_MAX_QUEUED_JOBS', 0))
 EC2M_MIN_IDLE_WORKERS = int(env('EC2M_MIN_IDLE_WORKERS', 0))
 EC2M_IDLE_UPTIME_THRESHOLD = int(env('EC2M_IDLE_UPTIME_THRESHOLD', 55)) # this should be tweaked based on frequency of any autoscale cron jobs
 
+# 'backoff' or 'fixed'; the fixed strategy polls every EC2M_WAIT_TIME seconds
+# up to EC2M_WAIT_RETRIES times
+EC2M_WAIT_STRATEGY = env('EC2M_WAIT_STRATEGY', 'backoff')
 EC2M_WAIT_RETRIES = int(env('EC2M_WAIT_RETRIES', 10))
 EC2M_WAIT_TIME = int(env('EC2M_WAIT_TIME', 10))
+# backoff strategy: first interval, max interval and overall deadline (seconds)
+EC2M_WAIT_INITIAL = float(env('EC2M_WAIT_INITIAL', 1))
+EC2M_WAIT_MAX_INTERVAL = float(env('EC2M_WAIT_MAX_INTERVAL', 30))
+EC2M_WAIT_TIMEOUT = int(env('EC2M_WAIT_TIMEOUT', EC2M_WAIT_RETRIES * EC2M_WAIT_TIME))
+
+# how long (seconds) a cluster's list of instances is cached between runs;
+# 0 disables the cache
+EC2M_INVENTORY_TTL = int(env('EC2M_INVENTORY_TTL', 900))
+
+# max age in seconds of cached opsworks stack name -> id lookups
+EC2M_STACK_ID_TTL = int(env('EC2M_STACK_ID_TTL', 86400))
+
+# max number of instance ids per ec2 start/stop api call
+EC2M_API_BATCH_SIZE = int(env('EC2M_API_BATCH_SIZE', 50))
+
+# max number of matterhorn maintenance requests to have in flight at once
+EC2M_MAINTENANCE_CONCURRENCY = int(env('EC2M_MAINTENANCE_CONCURRENCY', 10))
+
+# max age in seconds of the cached matterhorn host registry
+EC2M_MH_HOSTS_TTL = int(env('EC2M_MH_HOSTS_TTL', 30))
+
+# max age in seconds of a cluster's cached instance <-> matterhorn host mapping
+EC2M_MH_HOST_MAP_TTL = int(env('EC2M_MH_HOST_MAP_TTL', 3600))
+
+# consecutive failures to reach a cluster's matterhorn before giving up on
+# it for EC2M_MH_BREAKER_COOLDOWN seconds; 0 to always keep trying
+EC2M_MH_BREAKER_THRESHOLD = int(env('EC2M_MH_BREAKER_THRESHOLD', 3))
+EC2M_MH_BREAKER_COOLDOWN = int(env('EC2M_MH_BREAKER_COOLDOWN', 300))
+
+# how autoscale decides to add workers: 'threshold' adds one whenever the
+# queued high load jobs exceed EC2M_MAX_QUEUED_JOBS; 'forecast' adds as many
+# as the recorded queue history says will be needed; 'throughput' adds enough
+# to clear the current backlog (see controllers/history.py)
+EC2M_AUTOSCALE_MODE = env('EC2M_AUTOSCALE_MODE', 'threshold')
+
+# how long (seconds) to keep each cluster's queue depth/worker count history,
+# and the minimum gap between samples; 0 (the default) disables recording.
+# recording means autoscale counts every queued job rather than stopping once
+# EC2M_MAX_QUEUED_JOBS is exceeded
+EC2M_HISTORY_RETENTION = int(env('EC2M_HISTORY_RETENTION', 0))
+EC2M_HISTORY_MIN_INTERVAL = int(env('EC2M_HISTORY_MIN_INTERVAL', 30))
+
+# 'forecast' autoscaling fits the last EC2M_FORECAST_WINDOW seconds of history
+# and projects the backlog EC2M_FORECAST_HORIZON seconds ahead, adding at most
+# EC2M_FORECAST_MAX_STEP workers per run
+EC2M_FORECAST_WINDOW = int(env('EC2M_FORECAST_WINDOW', 900))
+EC2M_FORECAST_HORIZON = int(env('EC2M_FORECAST_HORIZON', 300))
+EC2M_FORECAST_MAX_STEP = int(env('EC2M_FORECAST_MAX_STEP', 5))
+
+# 'throughput' autoscaling starts enough workers to clear the backlog within
+# EC2M_BACKLOG_DRAIN_TIME seconds of their taking EC2M_WORKER_BOOT_TIME seconds
+# to come online, at the per-worker throughput observed over the last
+# EC2M_THROUGHPUT_WINDOW seconds of history, or EC2M_WORKER_THROUGHPUT high load
+# jobs per worker per hour if there's none to go on
+EC2M_WORKER_BOOT_TIME = int(env('EC2M_WORKER_BOOT_TIME', 300))
+EC2M_BACKLOG_DRAIN_TIME = int(env('EC2M_BACKLOG_DRAIN_TIME', 900))
+EC2M_THROUGHPUT_WINDOW = int(env('EC2M_THROUGHPUT_WINDOW', 86400))
+EC2M_WORKER_THROUGHPUT = float(env('EC2M_WORKER_THROUGHPUT', 12))
+
+# number of running workflows to fetch per matterhorn api request
+EC2M_MH_WORKFLOW_PAGE_SIZE = int(env('EC2M_MH_WORKFLOW_PAGE_SIZE', 100))
+
+# how long (seconds) `status` gives the walk over the running workflows to
+# count queued jobs, which takes a couple of requests per running operation
+EC2M_MH_QUEUE_SCAN_TIMEOUT = int(env('EC2M_MH_QUEUE_SCAN_TIMEOUT', 120))
+
+# how often the multi-cluster daemon autoscales each cluster by default, and
+# how often it rediscovers each cluster's instances (seconds)
+EC2M_DAEMON_INTERVAL = int(env('EC2M_DAEMON_INTERVAL', 60))
+EC2M_DAEMON_REDISCOVER_INTERVAL = int(env('EC2M_DAEMON_REDISCOVER_INTERVAL', 3600))
+
+# max number of clusters the multi-cluster status command queries at once
+EC2M_STATUS_CONCURRENCY = int(env('EC2M_STATUS_CONCURRENCY', 16))
 
 #AWS bits
 AWS_REGION = env('AWS_REGION', 'us-east-1')
@@ -44,4 +128,13 @@ LOGGLY_TOKEN = env('LOGGLY_TOKEN')
 LOGGLY_URL = 'logs-01.loggly.com'
 LOGGLY_TAGS = 'ec2-manager'
 
+# max number of log records sent to loggly per request
+LOGGLY_BATCH_SIZE = int(env('LOGGLY_BATCH_SIZE', 100))
+
+# max number of log records waiting to be sent; more than this get dropped
+LOGGLY_BUFFER_SIZE = int(env('LOGGLY_BUFFER_SIZE', 1000))
+
+# how long in seconds to spend sending buffered log records at exit
+LOGGLY_FLUSH_TIMEOUT = int(env('LOGGLY_FLUSH_TIMEOUT', 5))
+
 PYHORN_TIMEOUT = env('PYHORN_TIMEOUT', 30)
@@ -2,8 +2,12 @@
 import click
 click.disable_unicode_literals_warning = True
 
+import os
+import sys
+import json
 import logging
 import unittest
+import subprocess
 from mock import patch
 from click.testing import CliRunner
 
@@ -11,7 +15,7 @@ import utils
 import ec2_manager
 from ec2_manager import cli, handle_exit
 from controllers.ec2 import log_before_after_stats, admin_is_up
-import controllers
+import controllers.exceptions
 
 @patch.object(utils, 'init_logging', autospec=True)
 @patch.object(ec2_manager, 'EC2Controller', autospec=True)
@@ -102,7 +106,7 @@ class CliTests(unittest.TestCase):
 
         # ClusterException raised during command invocation should be caught
         # and result in a sys.exit with the exception
-        result = self.runner.invoke(cli, ['dev99', 'baz', '--exc_type', 'controllers.ClusterException'])
+        result = self.runner.invoke(cli, ['dev99', 'baz', '--exc_type', 'controllers.exceptions.ClusterException'])
         self.assertEqual(result.exit_code, 1)
         self.assertIsInstance(result.exception, SystemExit)
         self.assertEqual(result.exception.message, 'Boom!')
@@ -120,3 +124,22 @@ class CliTests(unittest.TestCase):
 
         result = self.runner.invoke(cli, ['--opsworks', 'dev99', 'foobar'])
         self.assertIsInstance(result.exception, NotImplementedError)
+
+
+class ImportTests(unittest.TestCase):
+
+    # loaded only by the commands/controllers that use them
+    deferred = ['pyhorn', 'boto.ec2', 'boto.opsworks', 'pyloggly',
+                'arrow', 'requests']
+
+    def test_import_footprint(self):
+        # a fresh interpreter, as this one has already imported everything
+        script = ("import sys, json; "
+                  "import ec2_manager, ec2_manager_multi; "
+                  "print json.dumps([m for m in sys.modules if sys.modules[m]])")
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         cwd=os.path.dirname(os.path.dirname(__file__)) or '.')
+        modules = json.loads(output.splitlines()[-1])
+
+        loaded = [x for x in self.deferred if x in modules]
+        self.assertEqual(loaded, [], "cli imports shouldn't load {}".format(', '.join(loaded)))
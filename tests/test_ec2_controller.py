@@ -1,13 +1,22 @@
 
+import shutil
 import logging
+import tempfile
 import unittest
 import boto.ec2
 from boto.exception import EC2ResponseError
 from moto import mock_ec2
 from mock import Mock, patch, PropertyMock
-from controllers.exceptions import ClusterException, ScalingException
+from controllers.exceptions import ClusterException, ScalingException, \
+    GiveUpWaitingException, MatterhornControllerException, \
+    MatterhornCommunicationException, DeadlineExceeded
+from controllers.wait import ExponentialBackoff, FixedInterval
 
-from controllers import EC2Controller, matterhorn
+import time
+import utils
+import settings
+from controllers import matterhorn
+from controllers.ec2 import EC2Controller
 
 class EC2ControllerTests(unittest.TestCase):
 
@@ -20,8 +29,25 @@ class EC2ControllerTests(unittest.TestCase):
         self.ec2_mock = mock_ec2()
         self.ec2_mock.start()
 
+        # don't use/persist any cached inventories
+        self.inventory_ttl = patch.object(settings, 'EC2M_INVENTORY_TTL', 0)
+        self.inventory_ttl.start()
+
+        # nor record queue history, which the tests opt into
+        history_patch = patch.object(settings, 'EC2M_HISTORY_RETENTION', 0)
+        history_patch.start()
+        self.addCleanup(history_patch.stop)
+
+        # and keep anything else cached out of the real cache dir
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache_patch = patch.object(settings, 'EC2M_CACHE_DIR', cache_dir)
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+
     def tearDown(self):
         self.ec2_mock.stop()
+        self.inventory_ttl.stop()
 
     def test_init(self):
 
@@ -44,11 +70,19 @@ class EC2ControllerTests(unittest.TestCase):
         self.assertEqual(ec2.connection.region.name, 'us-west-1')
 
     @patch.object(boto.ec2.EC2Connection, 'describe_account_attributes')
-    def test_connection_401(self, mock_daa):
+    @patch.object(boto.ec2.EC2Connection, 'get_only_instances')
+    def test_connection_401(self, mock_goi, mock_daa):
 
-        mock_daa.side_effect = EC2ResponseError('401', 'No ec2 for you!')
+        mock_goi.side_effect = EC2ResponseError('401', 'No ec2 for you!')
         ec2 = EC2Controller('dev99')
-        self.assertRaises(SystemExit, ec2.create_connection)
+        # no validation request up front
+        ec2.create_connection()
+        self.assertFalse(mock_daa.called)
+        # the first real request exits on bad credentials
+        self.assertRaises(SystemExit, getattr, ec2, 'instances')
+
+        mock_goi.side_effect = EC2ResponseError('500', 'Oops')
+        self.assertRaises(EC2ResponseError, getattr, ec2, 'instances')
 
     def test_instance_tag(self):
 
@@ -75,6 +109,138 @@ class EC2ControllerTests(unittest.TestCase):
         self.assertEqual(len(ec2.instances), 2)
         mock_goi.assert_called_with(filters={'tag:Name': 'dev99-*'})
 
+    @patch.object(boto.ec2.EC2Connection, 'get_only_instances')
+    def test_cached_inventory(self, mock_goi):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.inventory_ttl.stop()
+        self.inventory_ttl = patch.object(settings, 'EC2M_INVENTORY_TTL', 60)
+        self.inventory_ttl.start()
+
+        def instance(id, name, state='running'):
+            return Mock(id=id, tags={'Name': name}, state=state)
+
+        mock_goi.return_value = [instance('i-1', 'dev99-admin'), instance('i-2', 'dev99-worker')]
+        with patch.object(settings, 'EC2M_CACHE_DIR', cache_dir):
+            # first run does the tag filter search
+            self.assertEqual(len(EC2Controller('dev99').instances), 2)
+            mock_goi.assert_called_once_with(filters={'tag:Name': 'dev99-*'})
+
+            # later runs describe the cached ids
+            mock_goi.reset_mock()
+            self.assertEqual(len(EC2Controller('dev99').instances), 2)
+            mock_goi.assert_called_once_with(instance_ids=['i-1', 'i-2'])
+
+            # not for a different cluster though
+            mock_goi.reset_mock()
+            mock_goi.return_value = []
+            EC2Controller('dev98').instances
+            mock_goi.assert_called_once_with(filters={'tag:Name': 'dev98-*'})
+
+            # fall back to the search if the inventory no longer matches
+            mock_goi.reset_mock()
+            mock_goi.side_effect = [
+                [instance('i-1', 'dev99-admin'), instance('i-2', 'dev99-worker', 'terminated')],
+                [instance('i-1', 'dev99-admin')]
+            ]
+            self.assertEqual(len(EC2Controller('dev99').instances), 1)
+            mock_goi.assert_called_with(filters={'tag:Name': 'dev99-*'})
+
+            mock_goi.reset_mock()
+            mock_goi.side_effect = [
+                EC2ResponseError('400', 'Bad Request', body=
+                    '<Response><Errors><Error><Code>InvalidInstanceID.NotFound</Code>'
+                    '<Message>nope</Message></Error></Errors></Response>'),
+                [instance('i-1', 'dev99-admin')]
+            ]
+            self.assertEqual(len(EC2Controller('dev99').instances), 1)
+            mock_goi.assert_called_with(filters={'tag:Name': 'dev99-*'})
+
+    @patch.object(boto.ec2.EC2Connection, 'describe_account_attributes')
+    @patch.object(boto.ec2.EC2Connection, 'get_only_instances')
+    def test_refresh_instances(self, mock_goi, mock_daa):
+        mock_goi.return_value = [
+            boto.ec2.instance.Instance(),
+            boto.ec2.instance.Instance()
+        ]
+        for idx, inst in enumerate(mock_goi.return_value):
+            inst.id = 'i-%d' % idx
+            inst.tags = {'Name': 'dev99-worker'}
+            inst._state = boto.ec2.instance.InstanceState(80, 'stopped')
+        ec2 = EC2Controller('dev99')
+        instances = ec2.instances
+
+        fresh = boto.ec2.instance.Instance()
+        fresh.id = 'i-1'
+        fresh._state = boto.ec2.instance.InstanceState(16, 'running')
+        mock_goi.reset_mock()
+        mock_goi.return_value = [fresh]
+        ec2.refresh_instances(instances[1:])
+
+        # one describe call, only for the requested ids
+        mock_goi.assert_called_once_with(instance_ids=['i-1'])
+        # state patched into the same proxy objects
+        self.assertIs(ec2.instances[1], instances[1])
+        self.assertEqual(ec2.instances[0].state, 'stopped')
+        self.assertEqual(ec2.instances[1].state, 'running')
+
+    @patch.object(boto.ec2.EC2Connection, 'get_only_instances')
+    def test_instance_index(self, mock_goi):
+        ec2 = EC2Controller('dev99')
+        ec2._instances = [
+            Mock(id='i-0', state='running', tags={'Name': 'dev99-admin'}),
+            Mock(id='i-1', state='stopped', tags={'Name': 'dev99-worker'}),
+            Mock(id='i-2', state='running', tags={'Name': 'dev99-worker'}),
+            Mock(id='i-3', state='stopped', tags={'Name': 'dev99-worker'}),
+            Mock(id='i-4', state='running', tags={'Name': 'dev99-nfs'})
+        ]
+        with patch.object(ec2, 'is_mh', wraps=ec2.is_mh) as mock_is_mh:
+            for i in range(3):
+                self.assertEqual([x.id for x in ec2.mh_instances], ['i-0', 'i-1', 'i-2', 'i-3'])
+                self.assertEqual([x.id for x in ec2.workers], ['i-1', 'i-2', 'i-3'])
+            # roles are only worked out once per instance
+            self.assertEqual(mock_is_mh.call_count, 10)
+        self.assertEqual([x.id for x in ec2.support_instances], ['i-4'])
+        self.assertEqual([x.id for x in ec2.workers_in_state('stopped')], ['i-1', 'i-3'])
+        self.assertEqual([x.id for x in ec2.index.in_state('running')], ['i-0', 'i-2', 'i-4'])
+
+        # refreshing moves instances between state buckets
+        ec2._instances[3].state = 'running'
+        mock_goi.return_value = [Mock(id='i-3')]
+        ec2.refresh_instances([ec2._instances[3]])
+        self.assertEqual([x.id for x in ec2.workers_in_state('stopped')], ['i-1'])
+        self.assertEqual([x.id for x in ec2.workers_in_state('running')], ['i-2', 'i-3'])
+
+        # callers can't alter the index through the returned lists
+        ec2.workers.pop()
+        self.assertEqual(len(ec2.workers), 3)
+
+        # a new instance list gets a new index
+        ec2._instances = ec2._instances[:2]
+        self.assertEqual([x.id for x in ec2.workers], ['i-1'])
+
+    @patch.object(EC2Controller, 'refresh_instances')
+    def test_reset(self, mock_refresh):
+        ec2 = EC2Controller('dev99')
+        ec2._instances = [Mock(tags={'Name': 'dev99-admin'}, ip_address='1.1.1.1')]
+        ec2._mh = Mock()
+        ec2._mh.client.base_url = 'http://1.1.1.1'
+        ec2.instance_actions = [{'instance': Mock(), 'action': 'started'}]
+
+        ec2.reset()
+        mock_refresh.assert_called_once_with()
+        ec2._mh.invalidate_hosts.assert_called_once_with()
+        self.assertEqual(ec2.instance_actions, [])
+
+        # admin address changed
+        ec2._instances[0].ip_address = '2.2.2.2'
+        ec2.reset()
+        self.assertFalse(hasattr(ec2, '_mh'))
+
+        ec2.reset(rediscover=True)
+        self.assertFalse(hasattr(ec2, '_instances'))
+        self.assertFalse(hasattr(ec2, '_admin'))
+
     def test_get_admin_node(self):
         ec2 = EC2Controller('dev99')
         ec2._instances = [
@@ -138,6 +304,36 @@ class EC2ControllerTests(unittest.TestCase):
         started_ids = [x.id for x in started_instances]
         self.assertEqual(started_ids, [2, 4, 6, 5])
 
+    @patch('controllers.ec2.time.sleep')
+    def test_wait_for_state(self, mock_sleep):
+        ec2 = EC2Controller('dev99')
+
+        # converges on the 4th poll
+        def state_cb(instances):
+            return mock_sleep.call_count == 3
+        strategy = ExponentialBackoff(1, 5, 100, jitter=0)
+        ec2.wait_for_state(state_cb, [], strategy=strategy)
+        self.assertEqual([x[0][0] for x in mock_sleep.call_args_list], [1, 2, 4])
+        self.assertEqual(ec2.wait_stats[0]['callback'], 'state_cb')
+        self.assertEqual(ec2.wait_stats[0]['polls'], 4)
+        self.assertIsNotNone(ec2.wait_stats[0]['converged'])
+
+        # intervals are capped at the max
+        intervals = ExponentialBackoff(1, 5, 100, jitter=0).intervals()
+        self.assertEqual([next(intervals) for x in range(5)], [1, 2, 4, 5, 5])
+
+        # never converges
+        mock_sleep.reset_mock()
+        self.assertRaises(GiveUpWaitingException, ec2.wait_for_state,
+                          lambda x: False, [], strategy=FixedInterval(10, 3))
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertEqual(ec2.wait_stats[1]['polls'], 3)
+        self.assertIsNone(ec2.wait_stats[1]['converged'])
+
+        # unless forced
+        ec2.force = True
+        ec2.wait_for_state(lambda x: False, [], strategy=FixedInterval(10, 3))
+
     @patch.object(EC2Controller, 'start_zadara')
     @patch.object(EC2Controller, 'maintenance_off')
     @patch.object(EC2Controller, 'start_support_instances')
@@ -206,6 +402,103 @@ class EC2ControllerTests(unittest.TestCase):
         self.assertTrue(ec2.autoscale_off)
         self.assertRaises(ScalingException, ec2.autoscale)
 
+    @patch.object(EC2Controller, 'scale_up')
+    @patch.object(EC2Controller, 'queue_sample')
+    def test_autoscale_forecast(self, mock_sample, mock_scale_up):
+        mock_sample.return_value = {'queued_high_load_jobs': 8, 'workers': 8}
+        for name, value in [('EC2M_HISTORY_RETENTION', 3600),
+                            ('EC2M_MAX_QUEUED_JOBS', 2),
+                            ('EC2M_FORECAST_HORIZON', 300),
+                            ('EC2M_FORECAST_MAX_STEP', 5)]:
+            settings_patch = patch.object(settings, name, value)
+            settings_patch.start()
+            self.addCleanup(settings_patch.stop)
+
+        def controller():
+            ec2 = EC2Controller('dev99')
+            ec2._admin = Mock(tags={'Name': 'dev99-admin'})
+            ec2._mh = Mock(is_in_maintenance=Mock(return_value=True))
+            ec2._instances = [
+                Mock(id='i-%d' % x, state=x < 2 and 'running' or 'stopped',
+                     tags={'Name': 'dev99-worker'})
+                for x in range(8)
+            ]
+            return ec2
+
+        # backlog has grown by 4 every 5 minutes
+        now = time.time()
+        ec2 = controller()
+        ec2.history.record({'queued_high_load_jobs': 0}, now=now - 600)
+        ec2.history.record({'queued_high_load_jobs': 4}, now=now - 300)
+
+        with patch.object(settings, 'EC2M_AUTOSCALE_MODE', 'forecast'):
+            ec2.autoscale()
+        # 12 projected, so (12 - 2) / 2
+        mock_scale_up.assert_called_once_with(num_workers=5)
+        self.assertEqual(len(ec2.history.samples()), 3)
+
+        # threshold mode still records, but only adds one
+        mock_scale_up.reset_mock()
+        controller().autoscale()
+        mock_scale_up.assert_called_once_with(num_workers=1)
+
+        # without recording it only counts as far as it needs to
+        mock_scale_up.reset_mock()
+        mock_sample.reset_mock()
+        ec2 = controller()
+        ec2._mh.queued_jobs_exceed.return_value = True
+        with patch.object(settings, 'EC2M_HISTORY_RETENTION', 0):
+            ec2.autoscale()
+        self.assertFalse(mock_sample.called)
+        ec2._mh.queued_jobs_exceed.assert_called_once_with(
+            2, operation_types=settings.MAJOR_LOAD_OPERATION_TYPES)
+        mock_scale_up.assert_called_once_with(num_workers=1)
+
+        # no more than there are workers to start
+        mock_scale_up.reset_mock()
+        ec2 = controller()
+        ec2._instances[2].state = ec2._instances[3].state = 'running'
+        with patch.object(settings, 'EC2M_AUTOSCALE_MODE', 'forecast'):
+            ec2.autoscale()
+        mock_scale_up.assert_called_once_with(num_workers=4)
+
+    @patch.object(EC2Controller, 'start_instances')
+    @patch.object(EC2Controller, 'queue_sample')
+    def test_autoscale_throughput(self, mock_sample, mock_start):
+        mock_sample.return_value = {'queued_high_load_jobs': 100, 'workers_online': 2}
+        for name, value in [('EC2M_AUTOSCALE_MODE', 'throughput'),
+                            ('EC2M_MAX_QUEUED_JOBS', 2),
+                            ('EC2M_MAX_WORKERS', 10)]:
+            settings_patch = patch.object(settings, name, value)
+            settings_patch.start()
+            self.addCleanup(settings_patch.stop)
+
+        ec2 = EC2Controller('dev99')
+        ec2._admin = Mock(tags={'Name': 'dev99-admin'})
+        ec2._mh = Mock(is_in_maintenance=Mock(return_value=True))
+        ec2._instances = [
+            Mock(id='i-%d' % x, state=x < 2 and 'running' or 'stopped',
+                 tags={'Name': 'dev99-worker'})
+            for x in range(12)
+        ]
+        ec2._mh.idle_map.return_value = dict((x.id, False) for x in ec2._instances)
+        ec2.autoscale()
+        # way more needed than allowed, all started at once
+        mock_start.assert_called_once_with(ec2._instances[2:10], wait=False)
+
+        # still over the threshold but the running workers can manage, so
+        # neither start nor stop any
+        mock_start.reset_mock()
+        mock_sample.return_value = {'queued_high_load_jobs': 3, 'workers_online': 2}
+        ec2._mh.idle_map.return_value = dict((x.id, True) for x in ec2._instances)
+        with patch.object(EC2Controller, 'scale_down') as mock_scale_down:
+            ec2.autoscale()
+            self.assertFalse(mock_scale_down.called)
+        self.assertFalse(mock_start.called)
+
+        with patch.object(settings, 'EC2M_AUTOSCALE_MODE', 'bogus'):
+            self.assertRaises(ScalingException, ec2.autoscale)
+
     def test_scale_to(self):
         ec2 = EC2Controller('dev99')
         ec2._instances = [
@@ -360,6 +653,60 @@ class EC2ControllerTests(unittest.TestCase):
         args, kwargs = mock_maint_off.call_args
         self.assertEqual(args[0], instances[1:])
 
+    @patch('controllers.ec2.settings', autospec=True)
+    def test_set_maintenance(self, mock_settings):
+
+        mock_settings.EC2M_MAINTENANCE_CONCURRENCY = 2
+        ec2 = EC2Controller('dev99')
+        ec2._mh = Mock()
+        instances = [
+            Mock(id='a', tags={'Name': 'a'}, state="running"),
+            Mock(id='b', tags={'Name': 'b'}, state="running"),
+            Mock(id='c', tags={'Name': 'c'}, state="running"),
+        ]
+        ec2.set_maintenance(instances, True, wait=False)
+        self.assertEqual(
+            sorted(x[0][0].id for x in ec2._mh.maintenance_on.call_args_list),
+            ['a', 'b', 'c']
+        )
+        ec2._mh.invalidate_hosts.assert_called_once_with()
+
+        # errors are gathered per instance
+        def maint_off(inst):
+            if inst.id == 'b':
+                raise RuntimeError('Boom!')
+        ec2._mh.maintenance_off.side_effect = maint_off
+        self.assertRaisesRegexp(MatterhornControllerException, "off for b$",
+                                ec2.set_maintenance, instances, False, wait=False)
+        self.assertEqual(ec2._mh.maintenance_off.call_count, 3)
+
+        # no concurrency is still one at a time
+        mock_settings.EC2M_MAINTENANCE_CONCURRENCY = 0
+        ec2._mh.maintenance_on.reset_mock()
+        ec2.set_maintenance(instances, True, wait=False)
+        self.assertEqual(ec2._mh.maintenance_on.call_count, 3)
+
+    @patch.object(matterhorn.MatterhornController, 'create_instance_host_map')
+    @patch.object(matterhorn.MatterhornController, 'client_factory')
+    def test_mh_deadline(self, mock_factory, mock_host_map):
+        mock_factory.side_effect = lambda url, deadline=None: Mock(deadline=deadline)
+        ec2 = EC2Controller('dev99')
+        ec2._admin = Mock(ip_address='1.1.1.1')
+        ec2._instances = []
+
+        # connecting happens within the deadline
+        with ec2.mh_deadline(5) as deadline:
+            self.assertLessEqual(deadline.remaining(), 5)
+            ec2.mh
+            mock_factory.assert_called_once_with('http://1.1.1.1', deadline=deadline)
+            self.assertIs(ec2.mh.client.deadline, deadline)
+        self.assertIsNone(ec2.mh.client.deadline)
+
+        # as do requests by an existing client
+        with ec2.mh_deadline(5) as deadline:
+            self.assertIs(ec2.mh.client.deadline, deadline)
+        self.assertIsNone(ec2.mh.client.deadline)
+
     def test_instance_actions(self):
 
         ec2 = EC2Controller('dev99')
@@ -369,11 +716,107 @@ class EC2ControllerTests(unittest.TestCase):
         ec2.start_instance(inst)
         self.assertEqual(ec2.instance_actions[1], {'instance': inst, 'action': 'started'})
 
+    @patch('controllers.ec2.settings', autospec=True)
+    def test_batch_instance_action(self, mock_settings):
+
+        mock_settings.EC2M_API_BATCH_SIZE = 2
+        ec2 = EC2Controller('dev99')
+        ec2._connection = Mock()
+        instances = [
+            Mock(id=1, tags={'Name': 'dev99-worker'}),
+            Mock(id=2, tags={'Name': 'dev99-worker'}),
+            Mock(id=3, tags={'Name': 'dev99-worker'})
+        ]
+        # instance 2 doesn't come back in the response
+        ec2._connection.start_instances.side_effect = [[Mock(id=1)], [Mock(id=3)]]
+        ec2.batch_instance_action(instances, 'started')
+        self.assertEqual(ec2._connection.start_instances.call_count, 2)
+        ec2._connection.start_instances.assert_any_call([1, 2], dry_run=False)
+        ec2._connection.start_instances.assert_any_call([3], dry_run=False)
+        self.assertEqual(
+            [(x['instance'].id, x['action']) for x in ec2.instance_actions],
+            [(1, 'started'), (3, 'started')]
+        )
+
+        # a failed batch gets retried one instance at a time
+        ec2.instance_actions = []
+        ec2._connection.stop_instances.side_effect = EC2ResponseError('400', 'Nope')
+        instances[1].stop.side_effect = EC2ResponseError('400', 'Nope')
+        ec2.batch_instance_action(instances, 'stopped')
+        self.assertEqual(ec2._connection.stop_instances.call_count, 2)
+        instances[0].stop.assert_called_once_with(dry_run=False)
+        instances[2].stop.assert_called_once_with(dry_run=False)
+        self.assertEqual(
+            [(x['instance'].id, x['action']) for x in ec2.instance_actions],
+            [(1, 'stopped'), (3, 'stopped')]
+        )
+
+    @patch.object(settings, 'EC2M_MH_BREAKER_COOLDOWN', 60)
+    @patch.object(settings, 'EC2M_MH_BREAKER_THRESHOLD', 2)
+    @patch.object(matterhorn.MatterhornController, 'client_factory')
+    def test_mh_circuit_breaker(self, mock_factory):
+        mock_factory.side_effect = MatterhornCommunicationException("Boom!")
+
+        def status():
+            # a fresh controller each time, like separate runs
+            ec2 = EC2Controller('dev99')
+            ec2._admin = Mock(ip_address='1.1.1.1')
+            ec2._instances = [Mock(id='i-1', tags={'Name': 'dev99-admin'}, state='running')]
+            return ec2, ec2.status_summary()
+
+        for i in range(2):
+            ec2, summary = status()
+            self.assertNotIn('queued_jobs', summary)
+        self.assertEqual(mock_factory.call_count, 2)
+
+        # open; later runs don't even try
+        ec2, summary = status()
+        self.assertEqual(len(summary['instances']), 1)
+        self.assertNotIn('queued_jobs', summary)
+        self.assertEqual(mock_factory.call_count, 2)
+        self.assertRaisesRegexp(MatterhornCommunicationException, "not retrying",
+                                getattr, ec2, 'mh')
+
+        # half-open after the cooldown; one run gets to try again
+        later = time.time() + 61
+        with patch.object(utils.time, 'time', return_value=later):
+            self.assertTrue(ec2.mh_breaker.allow())
+            self.assertFalse(EC2Controller('dev99').mh_breaker.allow())
+            # that failed too, so it's open for another cooldown
+            ec2.mh_breaker.record_failure()
+            self.assertFalse(ec2.mh_breaker.allow())
+
+        with patch.object(utils.time, 'time', return_value=later + 61):
+            self.assertTrue(ec2.mh_breaker.allow())
+            ec2.mh_breaker.record_success()
+            # closed again
+            self.assertTrue(EC2Controller('dev99').mh_breaker.allow())
+
+    @patch.object(settings, 'EC2M_MH_BREAKER_THRESHOLD', 1)
+    @patch.object(matterhorn.pyhorn.MHClient, 'me')
+    @patch.object(matterhorn.pyhorn.MHClient, 'statistics')
+    @patch.object(matterhorn.pyhorn.MHClient, 'hosts')
+    @patch.object(matterhorn.MatterhornController, 'queued_job_histogram')
+    def test_mh_circuit_breaker_deadline(self, mock_qjh, mock_hosts, mock_stats, mock_me):
+
+        ec2 = EC2Controller('dev99')
+        ec2._admin = Mock(tags={'Name': 'dev99-admin'}, ip_address='5.5.5.5')
+        ec2._instances = []
+        ec2._mh = matterhorn.MatterhornController('http://matterhorn.example.edu')
+        mock_hosts.return_value = []
+        mock_qjh.side_effect = DeadlineExceeded("Too slow")
+
+        # slow isn't unreachable
+        summary = ec2.status_summary()
+        self.assertNotIn('queued_jobs', summary)
+        self.assertEqual(ec2.mh_breaker._state()['failures'], 0)
+        self.assertTrue(EC2Controller('dev99').mh_breaker.allow())
+
     @patch.object(matterhorn.pyhorn.MHClient, 'me')
     @patch.object(matterhorn.pyhorn.MHClient, 'statistics')
     @patch.object(matterhorn.pyhorn.MHClient, 'hosts')
-    @patch.object(matterhorn.MatterhornController, 'queued_job_count')
-    def test_unmappable_instance(self, mock_qjc, mock_hosts, mock_stats, mock_me):
+    @patch.object(matterhorn.MatterhornController, 'queued_job_histogram')
+    def test_unmappable_instance(self, mock_qjh, mock_hosts, mock_stats, mock_me):
 
         ec2 = EC2Controller('dev99')
 
@@ -388,7 +831,7 @@ class EC2ControllerTests(unittest.TestCase):
                 1: 'http://foo',
                 2: 'https://bar'
             }
-        mock_qjc.return_value = 0
+        mock_qjh.return_value = {}
         mock_stats.running_jobs = Mock(return_value=0)
         mock_hosts.return_value = [
             Mock(base_url='http://foo', maintenance=False),
@@ -397,3 +840,70 @@ class EC2ControllerTests(unittest.TestCase):
         summary = ec2.status_summary()
         self.assertEqual(len(summary['instances']), 3)
         self.assertEqual(summary['instances'][2]['mh_host'], 'unknown')
+
+    @patch.object(matterhorn.pyhorn.MHClient, 'me')
+    @patch.object(matterhorn.pyhorn.MHClient, 'statistics')
+    @patch.object(matterhorn.pyhorn.MHClient, 'hosts')
+    @patch.object(matterhorn.MatterhornController, 'queued_job_histogram')
+    def test_status_summary_fetch_error(self, mock_qjh, mock_hosts, mock_stats, mock_me):
+        from requests.exceptions import ConnectionError
+
+        ec2 = EC2Controller('dev99')
+        ec2._admin = Mock(tags={'Name': 'dev99-admin'}, ip_address='5.5.5.5')
+        ec2._instances = [Mock(id=1, tags={'Name': 'dev99-worker'}, state="running")]
+        ec2._mh = matterhorn.MatterhornController('http://matterhorn.example.edu')
+        mock_hosts.return_value = []
+        mock_qjh.side_effect = ConnectionError("refused")
+
+        # falls back to the ec2 info, and counts against the breaker
+        summary = ec2.status_summary()
+        self.assertNotIn('queued_jobs', summary)
+        self.assertEqual(len(summary['instances']), 1)
+        self.assertEqual(ec2.mh_breaker._state()['failures'], 1)
+
+    @patch.object(settings, 'EC2M_MH_QUEUE_SCAN_TIMEOUT', 60)
+    @patch.object(matterhorn.pyhorn.MHClient, 'me')
+    @patch.object(matterhorn.pyhorn.MHClient, 'statistics')
+    @patch.object(matterhorn.pyhorn.MHClient, 'hosts')
+    @patch.object(matterhorn.MatterhornController, 'queued_job_histogram')
+    def test_status_summary_deadlines(self, mock_qjh, mock_hosts, mock_stats, mock_me):
+
+        ec2 = EC2Controller('dev99')
+        ec2._admin = Mock(tags={'Name': 'dev99-admin'}, ip_address='5.5.5.5')
+        ec2._instances = []
+        ec2._mh = matterhorn.MatterhornController('http://matterhorn.example.edu')
+        deadlines = {}
+
+        def record(name, result):
+            def call(*args, **kwargs):
+                deadlines[name] = ec2._mh.client.deadline.seconds
+                return result
+            return call
+        mock_stats.side_effect = record('stats', Mock(running_jobs=Mock(return_value=0)))
+        mock_hosts.side_effect = record('hosts', [])
+        mock_qjh.side_effect = record('histogram', {})
+
+        # the workflow walk isn't held to the short deadline
+        summary = ec2.status_summary()
+        self.assertEqual(summary['queued_jobs'], 0)
+        self.assertEqual(deadlines, {'stats': 5, 'hosts': 5, 'histogram': 60})
+
+    @patch.object(matterhorn.pyhorn.MHClient, 'me')
+    @patch.object(matterhorn.pyhorn.MHClient, 'hosts')
+    @patch.object(matterhorn.MatterhornController, 'load_session', return_value=True)
+    def test_status_summary_cached_session_admin_down(self, mock_load, mock_hosts, mock_me):
+        from requests.exceptions import ConnectionError
+
+        mock_hosts.side_effect = ConnectionError("refused")
+        ec2 = EC2Controller('dev99')
+        ec2._admin = Mock(tags={'Name': 'dev99-admin'}, ip_address='5.5.5.5', state='running',
+                          private_ip_address='10.0.0.5', public_dns_name='admin',
+                          private_dns_name='admin-private')
+        ec2._instances = [ec2._admin]
+
+        # no connection check with a cached session, so the host registry
+        # fetch is the first request
+        summary = ec2.status_summary()
+        self.assertFalse(mock_me.called)
+        self.assertNotIn('queued_jobs', summary)
+        self.assertEqual(len(summary['instances']), 1)
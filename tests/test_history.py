@@ -0,0 +1,143 @@
+
+import json
+import shutil
+import tempfile
+import unittest
+from mock import patch
+
+import settings
+from controllers.history import QueueHistory, ForecastScaler, ThroughputScaler, \
+    fit_trend, backtest
+from controllers.exceptions import ScalingException
+
+class QueueHistoryTests(unittest.TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache_patch = patch.object(settings, 'EC2M_CACHE_DIR', cache_dir)
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+
+    def test_record(self):
+        history = QueueHistory('dev99', retention=3600, min_interval=30)
+        self.assertEqual(history.samples(), [])
+
+        sample = history.record({'queued_jobs': 3, 'workers': 2, 'foo': 1}, now=1000)
+        self.assertEqual(sample['time'], 1000)
+        self.assertNotIn('foo', sample)
+        # too soon after the last one
+        history.record({'queued_jobs': 4}, now=1010)
+        history.record({'queued_jobs': 5}, now=1030)
+
+        samples = QueueHistory('dev99').samples()
+        self.assertEqual([x['queued_jobs'] for x in samples], [3, 5])
+        self.assertEqual(samples[0]['workers'], 2)
+        self.assertIsNone(samples[1]['workers'])
+        self.assertEqual(len(history.samples(since=1020)), 1)
+
+    def test_prune(self):
+        history = QueueHistory('dev99', retention=100, min_interval=0)
+        for t in range(0, 120, 10):
+            history.record({'queued_jobs': t}, now=t)
+        # not rewritten until the oldest sample is well past expiry
+        self.assertEqual(len(history.samples()), 12)
+
+        history.record({'queued_jobs': 130}, now=130)
+        samples = history.samples()
+        self.assertEqual(samples[0]['time'], 30)
+        self.assertEqual(len(samples), 10)
+
+    def test_partial_line(self):
+        history = QueueHistory('dev99', min_interval=0)
+        history.record({'queued_jobs': 1}, now=1)
+        with open(history.path, 'a') as f:
+            f.write(json.dumps({'time': 2})[:5])
+        self.assertEqual(len(history.samples()), 1)
+
+
+class ForecastTests(unittest.TestCase):
+
+    def samples(self, values, step=60):
+        return [
+            {'time': i * step, 'queued_high_load_jobs': v}
+            for i, v in enumerate(values)
+        ]
+
+    def test_fit_trend(self):
+        self.assertEqual(fit_trend([], 'queued_high_load_jobs'), (0, 0))
+        self.assertEqual(fit_trend(self.samples([4]), 'queued_high_load_jobs'), (0, 4))
+        slope, level = fit_trend(self.samples([0, 1, 2, 3]), 'queued_high_load_jobs')
+        self.assertAlmostEqual(slope, 1 / 60.)
+        self.assertAlmostEqual(level, 3)
+
+    def test_workers_to_add(self):
+        scaler = ForecastScaler(window=600, horizon=300, max_step=5, threshold=2)
+
+        # flat backlog under the threshold
+        self.assertEqual(scaler.workers_to_add(self.samples([1, 1, 1])), 0)
+        # shrinking backlog won't be a problem by the time workers are up
+        self.assertEqual(scaler.workers_to_add(self.samples([12, 8, 4])), 0)
+        # growing by 1/min: 3 now, 8 in 5 minutes
+        self.assertEqual(scaler.forecast(self.samples([0, 1, 2, 3])), 8)
+        self.assertEqual(scaler.workers_to_add(self.samples([0, 1, 2, 3])), 3)
+        # capped
+        self.assertEqual(scaler.workers_to_add(self.samples([0, 10, 20])), 5)
+        # samples outside the window are ignored
+        self.assertEqual(scaler.workers_to_add(self.samples([50] + [1] * 11)), 0)
+
+    def test_backtest(self):
+        scaler = ForecastScaler(window=300, horizon=120, max_step=5, threshold=2)
+        samples = self.samples([0, 1, 2, 3, 4, 5, 6, 6, 6])
+        result = backtest(samples, scaler)
+        self.assertEqual(result['samples'], 9)
+        # the last two have nothing recorded 2 minutes on to compare with
+        self.assertEqual(result['points'], 7)
+        self.assertLess(result['forecast_mae'], result['naive_mae'])
+        self.assertGreater(result['scale_ups'], 0)
+        self.assertGreaterEqual(result['workers_added'], result['scale_ups'])
+
+        self.assertEqual(backtest([], scaler)['points'], 0)
+        self.assertIsNone(backtest([], scaler)['forecast_mae'])
+
+
+class ThroughputTests(unittest.TestCase):
+
+    def setUp(self):
+        self.scaler = ThroughputScaler(window=3600, boot_time=300, drain_time=900,
+                                       default_throughput=12, threshold=2)
+
+    def test_throughput(self):
+        # nothing to go on
+        self.assertAlmostEqual(self.scaler.throughput([]), 12 / 3600.)
+
+        samples = [
+            {'time': 0, 'queued_high_load_jobs': 20, 'workers_online': 2},
+            # 2 workers took 10 off in 5 minutes
+            {'time': 300, 'queued_high_load_jobs': 10, 'workers_online': 4},
+            # growing, so no use
+            {'time': 600, 'queued_high_load_jobs': 30, 'workers_online': 4},
+            # 4 workers took 20 off in 5 minutes
+            {'time': 900, 'queued_high_load_jobs': 10, 'workers_online': 4},
+            # too long a gap
+            {'time': 9000, 'queued_high_load_jobs': 0, 'workers_online': 4},
+        ]
+        self.assertAlmostEqual(self.scaler.throughput(samples), 30 / 1800.)
+
+    def test_workers_to_add(self):
+        def sample(queued, online):
+            return [{'time': 0, 'queued_high_load_jobs': queued, 'workers_online': online}]
+
+        self.assertEqual(self.scaler.workers_to_add([]), 0)
+        self.assertEqual(self.scaler.workers_to_add(sample(2, 2)), 0)
+        # 3 jobs take 900 worker seconds at 12/hour, which the 2 running
+        # workers manage while any new ones would be starting
+        self.assertEqual(self.scaler.workers_to_add(sample(3, 2)), 0)
+        # 30 jobs = 9000 worker seconds, 600 done while booting, the other
+        # 8400 in 900 seconds takes 10 workers
+        self.assertEqual(self.scaler.workers_to_add(sample(30, 2)), 8)
+        self.assertEqual(self.scaler.workers_to_add(sample(30, 0)), 10)
+
+    def test_invalid_settings(self):
+        self.assertRaises(ScalingException, ThroughputScaler, drain_time=0)
+        self.assertRaises(ScalingException, ThroughputScaler, default_throughput=0)
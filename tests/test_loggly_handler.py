@@ -0,0 +1,82 @@
+
+import logging
+import threading
+import unittest
+import requests
+from mock import Mock, patch
+
+from loggly_handler import BulkLogglyHandler
+
+class BulkLogglyHandlerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.posted = []
+        self.posting = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+        self.post_error = None
+
+        def post(session, url, data=None, timeout=None):
+            self.posting.set()
+            self.release.wait()
+            if self.post_error is not None:
+                raise self.post_error
+            self.posted.append((url, data.split('\n')))
+            return Mock(status_code=200)
+
+        post_patch = patch.object(requests.Session, 'post', autospec=True, side_effect=post)
+        post_patch.start()
+        self.addCleanup(post_patch.stop)
+
+        self.log = logging.getLogger('test-loggly')
+        self.log.propagate = False
+        self.log.setLevel(logging.DEBUG)
+
+    def handler(self, **kwargs):
+        handler = BulkLogglyHandler('token', 'loggly.example.com', tags='foo', **kwargs)
+        self.log.addHandler(handler)
+        self.addCleanup(self.log.removeHandler, handler)
+        return handler
+
+    def hold_worker(self):
+        # log one record and wait until the worker is stuck sending it
+        self.release.clear()
+        self.log.info("message 0")
+        self.posting.wait(5)
+
+    def test_batches(self):
+        handler = self.handler(batch_size=3)
+        self.hold_worker()
+        for i in range(1, 7):
+            self.log.info("message %d", i, extra={'stats': {'n': i}})
+        self.release.set()
+        handler.close()
+
+        self.assertFalse(handler.worker.is_alive())
+        self.assertEqual(self.posted[0][0], 'https://loggly.example.com/bulk/token/tag/foo')
+        self.assertEqual([len(x[1]) for x in self.posted], [1, 3, 3])
+        self.assertIn('message 6', self.posted[-1][1][-1])
+        # posted with our own session, not one of pyloggly's
+        self.assertFalse(hasattr(handler, 'session'))
+
+    def test_full_buffer(self):
+        handler = self.handler(buffer_size=2)
+        self.hold_worker()
+        for i in range(1, 5):
+            self.log.info("message %d", i)
+        # logging doesn't block; two get buffered and the rest dropped
+        self.assertEqual(handler.dropped, 2)
+        self.release.set()
+        with patch('sys.stderr') as mock_stderr:
+            handler.close()
+            self.assertIn("2 log records dropped", mock_stderr.write.call_args[0][0])
+        self.assertEqual(sum(len(x[1]) for x in self.posted), 3)
+
+    def test_post_failure(self):
+        self.post_error = requests.ConnectionError("nope")
+        handler = self.handler()
+        self.log.info("message")
+        with patch('sys.stderr') as mock_stderr:
+            handler.close()
+            self.assertIn("1 failed to send", mock_stderr.write.call_args[0][0])
+        self.assertFalse(handler.worker.is_alive())
@@ -1,17 +1,30 @@
 
+import os
+import stat
+import shutil
+import tempfile
 import requests
 import unittest
-from mock import Mock, patch
+from mock import Mock, patch, PropertyMock
 
 import pyhorn
 from pyhorn.endpoints import ServiceStatistics, ServiceHost
 
-from controllers import MatterhornController, MatterhornCommunicationException
+import utils
+import settings
+from controllers import matterhorn
+from controllers.matterhorn import MatterhornController
+from controllers.exceptions import MatterhornCommunicationException, DeadlineExceeded
 
 class MatterhornControllerTests(unittest.TestCase):
 
     def setUp(self):
 
+        # keep sessions, etc. out of the real cache dir
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_patch = patch.object(settings, 'EC2M_CACHE_DIR', self.cache_dir)
+        self.cache_patch.start()
+
         # prevent controller's client connection check from failing
         self.client_me_mock = patch.object(pyhorn.MHClient, 'me')
         self.client_me_mock.start()
@@ -26,6 +39,8 @@ class MatterhornControllerTests(unittest.TestCase):
     def tearDown(self):
         self.client_me_mock.stop()
         self.fail_requests.stop()
+        self.cache_patch.stop()
+        shutil.rmtree(self.cache_dir)
 
     def test_init(self):
         mh = MatterhornController('http://example.edu')
@@ -36,6 +51,45 @@ class MatterhornControllerTests(unittest.TestCase):
         self.assertRaises(MatterhornCommunicationException, MatterhornController, 'http://example.edu')
         self.client_me_mock.start()
 
+    def test_cached_session(self):
+        cookies = pyhorn.client._session.cookies
+        self.addCleanup(cookies.clear)
+
+        cookies.set('JSESSIONID', 'abc123', domain='example.edu', path='/')
+        cookies.set('JSESSIONID', 'zyx987', domain='example.com', path='/')
+        MatterhornController.client_factory('http://example.edu')
+        self.assertEqual(pyhorn.MHClient.me.call_count, 1)
+
+        # session file is private
+        cache_file = os.path.join(self.cache_dir, 'mh_sessions.json')
+        self.assertEqual(stat.S_IMODE(os.stat(cache_file).st_mode), 0600)
+
+        # a later run picks up the session and skips the connection check
+        cookies.clear()
+        MatterhornController.client_factory('http://example.edu')
+        self.assertEqual(pyhorn.MHClient.me.call_count, 1)
+        self.assertEqual(cookies.get('JSESSIONID', domain='example.edu'), 'abc123')
+        self.assertIsNone(cookies.get('JSESSIONID', domain='example.com'))
+
+        # unless a probe is asked for
+        MatterhornController.client_factory('http://example.edu', probe=True)
+        self.assertEqual(pyhorn.MHClient.me.call_count, 2)
+
+        # rejected sessions are forgotten
+        mh = MatterhornController('http://example.edu')
+        mh.client.statistics = Mock(side_effect=pyhorn.MHClientHTTPError("Access denied"))
+        self.assertRaises(MatterhornCommunicationException, mh.service_stats)
+        self.assertFalse(MatterhornController.load_session('http://example.edu'))
+
+        # as are sessions for an admin node that's gone away
+        MatterhornController.save_session('http://example.edu')
+        mh = MatterhornController('http://example.edu')
+        mh.client.hosts = Mock(side_effect=requests.exceptions.ConnectionError("refused"))
+        self.assertRaises(MatterhornCommunicationException, mh.hosts)
+        self.assertRaises(MatterhornCommunicationException,
+                          mh.create_instance_host_map, [])
+        self.assertFalse(MatterhornController.load_session('http://example.edu'))
+
     def test_create_instance_host_map(self):
         mh = MatterhornController('http://example.edu')
         fake_hosts = [
@@ -85,6 +139,72 @@ class MatterhornControllerTests(unittest.TestCase):
         }
         self.assertEqual(mh.instance_host_map, expected)
 
+    def test_instance_host_map_addresses(self):
+        mh = MatterhornController('http://example.edu')
+        fake_hosts = [
+            { "base_url": "http://10.0.0.1:8080" },
+            { "base_url": "https://Worker-2.example.edu/" },
+            { "base_url": "http://worker-2.example.edu" },
+        ]
+        mh.client.hosts = Mock(return_value=[ServiceHost(x, mh.client) for x in fake_hosts])
+        fake_instances = [
+            Mock(id='i-1', private_ip_address='10.0.0.1',
+                 public_dns_name='', private_dns_name='worker-1.example.edu'),
+            Mock(id='i-2', private_ip_address='10.0.0.2',
+                 public_dns_name=None, private_dns_name='worker-2.example.edu'),
+        ]
+        mh.create_instance_host_map(fake_instances)
+        self.assertEqual(mh.instance_host_map, {
+            'i-1': "http://10.0.0.1:8080",
+            'i-2': "https://Worker-2.example.edu/"
+        })
+
+    def test_cached_instance_host_map(self):
+        fake_hosts = [{ "base_url": "http://1.1.1.1" }, { "base_url": "http://2.2.2.2" }]
+        fake_instances = [
+            Mock(id='i-1', private_ip_address='1.1.1.1',
+                 public_dns_name='foo', private_dns_name='foo-private'),
+            Mock(id='i-2', private_ip_address='2.2.2.2',
+                 public_dns_name='bar', private_dns_name='bar-private'),
+        ]
+        expected = {'i-1': "http://1.1.1.1", 'i-2': "http://2.2.2.2"}
+
+        mh = MatterhornController('http://example.edu')
+        mh.client.hosts = Mock(return_value=[ServiceHost(x, mh.client) for x in fake_hosts])
+        mh.create_instance_host_map(fake_instances, cache_key='dev99')
+        self.assertEqual(mh.instance_host_map, expected)
+        self.assertEqual(mh.client.hosts.call_count, 1)
+
+        # a later process reuses the mapping without fetching the hosts
+        mh = MatterhornController('http://example.edu')
+        mh.client.hosts = Mock(return_value=[ServiceHost(x, mh.client) for x in fake_hosts])
+        mh.create_instance_host_map(fake_instances, cache_key='dev99')
+        self.assertEqual(mh.instance_host_map, expected)
+        self.assertFalse(mh.client.hosts.called)
+
+        # but not once an instance's addresses have changed
+        fake_instances[1].private_ip_address = '3.3.3.3'
+        mh = MatterhornController('http://example.edu')
+        mh.client.hosts = Mock(return_value=[ServiceHost(x, mh.client) for x in fake_hosts])
+        mh.create_instance_host_map(fake_instances, cache_key='dev99')
+        self.assertTrue(mh.client.hosts.called)
+
+    def test_deadline(self):
+        mh = MatterhornController('http://example.edu', deadline=utils.Deadline(2))
+        # request timeouts are the time left, up to the usual timeout
+        self.assertGreater(mh.client.timeout, 1)
+        self.assertLessEqual(mh.client.timeout, 2)
+        mh.set_deadline(utils.Deadline(60))
+        self.assertEqual(mh.client.timeout, float(settings.PYHORN_TIMEOUT))
+
+        # requests aren't even started once the deadline has passed
+        mh.set_deadline(utils.Deadline(0))
+        mh.client.statistics = Mock(side_effect=lambda: mh.client.timeout)
+        self.assertRaises(DeadlineExceeded, mh.service_stats)
+
+        mh.set_deadline(None)
+        self.assertEqual(mh.client.timeout, settings.PYHORN_TIMEOUT)
+
     def test_service_stats(self):
         mh = MatterhornController('http://example.edu')
         mh.client.statistics = Mock(return_value={'foo': 1})
@@ -157,6 +277,67 @@ class MatterhornControllerTests(unittest.TestCase):
         self.assertEqual(mh.queued_job_count(operation_types=["foo","bar"]), 8)
         self.assertEqual(mh.queued_job_count(operation_types=["foo","bar","baz"]), 9)
 
+        # a single pass over the workflows answers any filtered count
+        mh.client.workflows.reset_mock()
+        histogram = mh.queued_job_histogram()
+        self.assertEqual(histogram, {"foo": 4, "bar": 4, "baz": 1})
+        self.assertEqual(mh.queued_job_count(histogram=histogram), 9)
+        self.assertEqual(mh.queued_job_count(operation_types=["bar","baz"], histogram=histogram), 5)
+        self.assertEqual(mh.client.workflows.call_count, 1)
+
+    def test_queued_jobs_exceed(self):
+        mh = MatterhornController('http://example.edu')
+        mh.client = Mock()
+        mh.client.workflows.return_value = [
+            Mock(operations=[
+                Mock(id="bar", state="RUNNING",
+                     job=Mock(children=[Mock(status="QUEUED")])),
+                Mock(id="foo", state="RUNNING",
+                     job=Mock(children=[Mock(status="QUEUED"), Mock(status="QUEUED")])),
+                Mock(id="foo", state="RUNNING",
+                     job=Mock(children=[Mock(status="QUEUED")])),
+            ]),
+        ]
+        self.assertTrue(mh.queued_jobs_exceed(0, operation_types=["foo"]))
+        self.assertTrue(mh.queued_jobs_exceed(2, operation_types=["foo"]))
+        self.assertFalse(mh.queued_jobs_exceed(3, operation_types=["foo"]))
+        self.assertTrue(mh.queued_jobs_exceed(3))
+        self.assertFalse(mh.queued_jobs_exceed(0, operation_types=["baz"]))
+
+        # stops at the first match
+        type(mh.client.workflows.return_value[0].operations[2]).job = \
+            PropertyMock(side_effect=RuntimeError("Shouldn't get this far!"))
+        self.assertTrue(mh.queued_jobs_exceed(0, operation_types=["foo"]))
+
+    def test_running_workflows(self):
+        mh = MatterhornController('http://example.edu')
+        mh.client = Mock()
+        pages = [
+            [Mock(id=1), Mock(id=2)],
+            # 1 finished, so 3 moved onto the first page
+            [Mock(id=4), Mock(id=5)],
+            # and gets picked up when that's read again
+            [Mock(id=2), Mock(id=3)],
+            # 6 started and everything shifted back one
+            [Mock(id=5)],
+            [Mock(id=3), Mock(id=4)],
+        ]
+        mh.client.workflows.side_effect = pages
+        wfs = list(mh.running_workflows(page_size=2))
+        self.assertEqual([x.id for x in wfs], [1, 2, 4, 5, 3])
+        self.assertEqual(
+            [x[1]['startPage'] for x in mh.client.workflows.call_args_list],
+            [0, 1, 0, 2, 1]
+        )
+        mh.client.workflows.assert_called_with(state="RUNNING", count=2, startPage=1)
+
+        # stopping early doesn't fetch any more pages
+        mh.client.workflows.reset_mock()
+        mh.client.workflows.side_effect = pages
+        wfs = mh.running_workflows(page_size=2)
+        self.assertEqual(next(wfs).id, 1)
+        self.assertEqual(mh.client.workflows.call_count, 1)
+
     def test_is_idle(self):
 
         mh = MatterhornController('http://example.edu')
@@ -194,6 +375,13 @@ class MatterhornControllerTests(unittest.TestCase):
         self.assertFalse(mh.is_idle(Mock(id=1)))
         self.assertTrue(mh.is_idle(Mock(id=2)))
 
+        # whole fleet answered from a single statistics fetch
+        mh.client.statistics.reset_mock()
+        mh.instance_host_map[3] = "http://baz"
+        idle = mh.idle_map([Mock(id=1), Mock(id=2), Mock(id=3)])
+        self.assertEqual(idle, {1: False, 2: True, 3: True})
+        self.assertEqual(mh.client.statistics.call_count, 1)
+
     def test_is_in_maintenance(self):
         mh = MatterhornController('http://example.edu')
         mh.instance_host_map = {
@@ -213,3 +401,35 @@ class MatterhornControllerTests(unittest.TestCase):
         mh.client.hosts = Mock(return_value=[ServiceHost(x, mh.client) for x in fake_hosts])
         self.assertTrue(mh.is_in_maintenance(Mock(id=1)))
         self.assertFalse(mh.is_in_maintenance(Mock(id=2)))
+
+    def test_hosts_snapshot(self):
+        mh = MatterhornController('http://example.edu')
+        mh.instance_host_map = {
+            1: "http://foo",
+            2: "http://bar"
+        }
+        fake_hosts = [
+            { "base_url": "http://foo", "maintenance": True },
+            { "base_url": "http://bar", "maintenance": False }
+        ]
+        mh.client.hosts = Mock(return_value=[ServiceHost(x, mh.client) for x in fake_hosts])
+
+        # lookups share a single fetch of the host registry
+        self.assertTrue(mh.is_in_maintenance(Mock(id=1)))
+        self.assertFalse(mh.is_in_maintenance(Mock(id=2)))
+        self.assertEqual(mh.get_host_for_instance(Mock(id=2)).base_url, "http://bar")
+        self.assertEqual(mh.client.hosts.call_count, 1)
+
+        # unless fresh data is asked for
+        mh.is_in_maintenance(Mock(id=1), refresh=True)
+        self.assertEqual(mh.client.hosts.call_count, 2)
+
+        mh.invalidate_hosts()
+        mh.is_in_maintenance(Mock(id=1))
+        self.assertEqual(mh.client.hosts.call_count, 3)
+
+        # or the snapshot has expired
+        with patch('controllers.matterhorn.settings') as mock_settings:
+            mock_settings.EC2M_MH_HOSTS_TTL = -1
+            mh.is_in_maintenance(Mock(id=1))
+        self.assertEqual(mh.client.hosts.call_count, 4)
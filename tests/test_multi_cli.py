@@ -0,0 +1,99 @@
+import click
+click.disable_unicode_literals_warning = True
+
+import logging
+import unittest
+import threading
+from mock import Mock, patch
+
+import ec2_manager_multi
+from ec2_manager_multi import AutoscaleDaemon, parse_clusters, status_sweep
+from controllers.exceptions import ClusterException, MatterhornCommunicationException
+
+class AutoscaleDaemonTests(unittest.TestCase):
+
+    def setUp(self):
+        log = logging.getLogger()
+        if not log.handlers:
+            log.addHandler(logging.NullHandler())
+
+    def test_parse_clusters(self):
+        self.assertEqual(
+            parse_clusters(['dev01', 'dev02:120', 'dev03:30'], 60),
+            {'dev01': 60, 'dev02': 120, 'dev03': 30}
+        )
+        self.assertRaises(click.BadParameter, parse_clusters, ['dev01:soon'], 60)
+
+    @patch.object(ec2_manager_multi.utils, 'log_action_summary')
+    def test_run_cycle(self, mock_log_action):
+        controller_class = Mock()
+        daemon = AutoscaleDaemon({'dev01': 60}, controller_class=controller_class)
+
+        daemon.run_cycle('dev01')
+        daemon.run_cycle('dev01')
+        # controller is created once and reset before later cycles
+        controller_class.assert_called_once_with('dev01', dry_run=False, force=False)
+        cluster = controller_class.return_value
+        self.assertEqual(cluster.autoscale.call_count, 2)
+        cluster.reset.assert_called_once_with(rediscover=False)
+        self.assertEqual(mock_log_action.call_count, 2)
+
+        # a failing cycle doesn't take down the daemon
+        cluster.autoscale.side_effect = ClusterException("Nope")
+        daemon.run_cycle('dev01')
+        cluster.autoscale.side_effect = MatterhornCommunicationException("Nope")
+        daemon.run_cycle('dev01')
+        cluster.reset.assert_called_with(rediscover=True)
+        cluster.autoscale.side_effect = KeyError("Nope")
+        daemon.run_cycle('dev01')
+
+        # nothing to do if the admin isn't up
+        cluster.autoscale.reset_mock()
+        cluster.admin_is_up.return_value = False
+        daemon.run_cycle('dev01')
+        self.assertFalse(cluster.autoscale.called)
+
+    @patch.object(ec2_manager_multi.time, 'sleep')
+    @patch.object(ec2_manager_multi.time, 'time')
+    @patch.object(AutoscaleDaemon, 'run_cycle')
+    def test_run_schedule(self, mock_cycle, mock_time, mock_sleep):
+        clock = [1000]
+        mock_time.side_effect = lambda: clock[0]
+        def sleep(seconds):
+            clock[0] += seconds
+        mock_sleep.side_effect = sleep
+
+        daemon = AutoscaleDaemon({'dev01': 60, 'dev02': 25})
+        daemon.run(max_cycles=6)
+        self.assertEqual(
+            [x[0][0] for x in mock_cycle.call_args_list],
+            # dev02 runs 2x as often as dev01
+            ['dev01', 'dev02', 'dev02', 'dev02', 'dev01', 'dev02']
+        )
+
+    def test_status_sweep(self):
+        prefixes = ['dev01', 'dev02', 'dev03']
+        started = []
+        all_started = threading.Event()
+
+        def controller_class(prefix):
+            def status_summary():
+                started.append(prefix)
+                if len(started) == len(prefixes):
+                    all_started.set()
+                # only returns if the other clusters are being queried at
+                # the same time
+                all_started.wait(5)
+                if not all_started.is_set():
+                    raise RuntimeError("Not concurrent!")
+                if prefix == 'dev02':
+                    raise ClusterException("Can't find an admin node for your cluster!")
+                return {'cluster': prefix}
+            return Mock(status_summary=status_summary)
+
+        stats = status_sweep(prefixes, controller_class)
+        self.assertEqual(stats, {'clusters': [
+            {'cluster': 'dev01'},
+            {'cluster': 'dev02', 'error': "Can't find an admin node for your cluster!"},
+            {'cluster': 'dev03'}
+        ]})
@@ -1,16 +1,30 @@
 
+import shutil
+import tempfile
 import unittest
 import boto.opsworks.layer1
 import boto.ec2
+from boto.exception import JSONResponseError
 from moto import mock_ec2
 from mock import Mock, patch
 
-from controllers import EC2Controller, OpsworksController
+import settings
+from controllers import opsworks
+from controllers.ec2 import EC2Controller
+from controllers.opsworks import OpsworksController
 from controllers.exceptions import ClusterException
 
 @patch.object(boto.ec2.EC2Connection, 'describe_account_attributes')
 class OpsworksControllerTests(unittest.TestCase):
 
+    def setUp(self):
+        # keep cached stack ids, etc. out of the real cache dir
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache_patch = patch.object(settings, 'EC2M_CACHE_DIR', cache_dir)
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+
     @mock_ec2
     def test_connection_init(self, mock_daa):
 
@@ -47,10 +61,36 @@ class OpsworksControllerTests(unittest.TestCase):
         ]
         ops = OpsworksController('foobar')
         ops._stack = {'StackId': 123}
+        settings_patch = patch('controllers.ec2.settings.EC2M_INVENTORY_TTL', 0)
+        settings_patch.start()
+        self.addCleanup(settings_patch.stop)
         self.assertIsInstance(ops.instances, list)
         self.assertEqual(len(ops.instances), 2)
         mock_goi.assert_called_with(filters={'tag:opsworks:stack': 'foobar'})
 
+    @patch.object(boto.ec2.EC2Connection, 'get_only_instances')
+    @patch.object(boto.opsworks.layer1.OpsWorksConnection, 'describe_instances')
+    def test_instances_missing(self, mock_di, mock_goi, mock_daa):
+        mock_di.return_value = {
+            'Instances': [
+                {'InstanceId': 'asdf', 'Ec2InstanceId': 'i-1'},
+                # not started yet, so no ec2 instance
+                {'InstanceId': 'qwer'},
+            ]
+        }
+        mock_goi.return_value = [
+            Mock(id='i-%d' % x, tags={'Name': 'w%d' % x, 'opsworks:layer:workers': 1})
+            for x in range(1, 4)
+        ]
+        ops = OpsworksController('foobar')
+        ops._stack = {'StackId': 123}
+        settings_patch = patch('controllers.ec2.settings.EC2M_INVENTORY_TTL', 0)
+        settings_patch.start()
+        self.addCleanup(settings_patch.stop)
+        # all the unmatched instances get reported at once
+        self.assertRaisesRegexp(ClusterException, "for i-2, i-3", getattr, ops, 'instances')
+        self.assertFalse(hasattr(ops, '_instances'))
+
     def test_is_admin(self, mock_daa):
 
         ops = OpsworksController('foobar')
@@ -87,6 +127,25 @@ class OpsworksControllerTests(unittest.TestCase):
             'opsworks:layer:storage': 'Storage'
         })))
 
+    def test_batch_instance_action(self, mock_daa):
+        ops = OpsworksController('foobar')
+        ops._opsworks = Mock(stop_instance=Mock(
+            side_effect=[None, JSONResponseError('400', 'Nope')]))
+        instances = [
+            Mock(id='i-%d' % i, tags={'Name': 'foobar-worker'},
+                 opsworks_instance={'InstanceId': i})
+            for i in range(3)
+        ]
+
+        # the instances stopped before the failure are still recorded
+        self.assertRaises(JSONResponseError, ops.batch_instance_action, instances, 'stopped')
+        self.assertEqual(ops._opsworks.stop_instance.call_count, 2)
+        self.assertEqual(
+            [(x['instance'].id, x['action']) for x in ops.instance_actions],
+            [('i-0', 'stopped')]
+        )
+        self.assertEqual(ops.action_summary()['stopped_ids'], 'i-0')
+
     def test_stack(self, mock_daa):
         ops = OpsworksController('foobar')
         ops._opsworks = Mock(describe_stacks = Mock(
@@ -102,4 +161,37 @@ class OpsworksControllerTests(unittest.TestCase):
         ops = OpsworksController('fizzbuzz')
         self.assertRaises(ClusterException, getattr, ops, 'stack')
 
+    def test_cached_stack_id(self, mock_daa):
+        def describe_stacks(stack_ids=None):
+            stacks = [{'Name': 'foobar', 'StackId': 1}, {'Name': 'froboz', 'StackId': 2}]
+            if stack_ids is None:
+                return {'Stacks': stacks}
+            if 3 in stack_ids:
+                raise JSONResponseError('400', 'Bad Request',
+                                        body={'__type': 'ResourceNotFoundException'})
+            return {'Stacks': [x for x in stacks if x['StackId'] in stack_ids]}
 
+        ops = OpsworksController('foobar')
+        ops._opsworks = Mock(describe_stacks=Mock(side_effect=describe_stacks))
+        self.assertEqual(ops.stack['StackId'], 1)
+        ops._opsworks.describe_stacks.assert_called_once_with()
+
+        # later runs only describe the one stack
+        ops = OpsworksController('foobar')
+        ops._opsworks = Mock(describe_stacks=Mock(side_effect=describe_stacks))
+        self.assertEqual(ops.stack['StackId'], 1)
+        ops._opsworks.describe_stacks.assert_called_once_with(stack_ids=[1])
+
+        # stale ids send us back to the full search
+        opsworks.stack_id_cache().set('foobar', 3)
+        ops = OpsworksController('foobar')
+        ops._opsworks = Mock(describe_stacks=Mock(side_effect=describe_stacks))
+        self.assertEqual(ops.stack['StackId'], 1)
+        ops._opsworks.describe_stacks.assert_called_with()
+
+    def test_stack_auth_error(self, mock_daa):
+        ops = OpsworksController('foobar')
+        ops._opsworks = Mock(describe_stacks=Mock(
+            side_effect=JSONResponseError('400', 'No opsworks for you!')
+        ))
+        self.assertRaises(SystemExit, getattr, ops, 'stack')
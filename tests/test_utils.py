@@ -0,0 +1,65 @@
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from mock import patch
+
+import utils
+import settings
+
+class FileCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache_patch = patch.object(settings, 'EC2M_CACHE_DIR', cache_dir)
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+
+    def run_threads(self, target, count=20):
+        threads = [threading.Thread(target=target, args=(i,)) for i in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def test_concurrent_set(self):
+        cache = utils.FileCache('test')
+        self.run_threads(lambda i: utils.FileCache('test').set('key%d' % i, i))
+        self.assertEqual(
+            sorted(cache.get('key%d' % i) for i in range(20)), range(20))
+        # no temp files left lying around
+        self.assertEqual(sorted(os.listdir(settings.EC2M_CACHE_DIR)),
+                         ['test.json', 'test.json.lock'])
+
+        self.run_threads(lambda i: cache.delete('key%d' % i), 10)
+        self.assertIsNone(cache.get('key0'))
+        self.assertEqual(cache.get('key10'), 10)
+
+    def test_delete_missing(self):
+        utils.FileCache('test').delete('key')
+        self.assertEqual(os.listdir(settings.EC2M_CACHE_DIR), [])
+
+    def test_update(self):
+        cache = utils.FileCache('test', ttl=60)
+        self.run_threads(lambda i: cache.update('count', lambda x: x + 1, default=0))
+        self.assertEqual(cache.get('count'), 20)
+        self.assertIsNone(cache.update('count', lambda x: None))
+        self.assertIsNone(cache.get('count'))
+
+    def test_concurrent_breaker_failures(self):
+        self.run_threads(
+            lambda i: utils.CircuitBreaker('mh', 100, 60).record_failure())
+        state = utils.CircuitBreaker('mh', 100, 60)._state()
+        self.assertEqual(state['failures'], 20)
+        self.assertIsNone(state['opened'])
+
+        # only one of the callers gets to probe once the cooldown is up
+        utils.CircuitBreaker('mh', 20, 60).record_failure()
+        probes = []
+        with patch.object(utils.time, 'time', return_value=utils.time.time() + 61):
+            self.run_threads(
+                lambda i: probes.append(utils.CircuitBreaker('mh', 20, 60).allow()))
+        self.assertEqual(probes.count(True), 1)
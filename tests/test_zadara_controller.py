@@ -1,7 +1,12 @@
-
+import pyhorn
+import requests
+import requests_cache
 import unittest
-from mock import patch
-from controllers import ZadaraController
+from mock import Mock, patch
+
+import utils
+from controllers.zadara import ZadaraController
+from controllers.exceptions import DeadlineExceeded
 
 class ZadaraControllerTests(unittest.TestCase):
 
@@ -9,3 +14,72 @@ class ZadaraControllerTests(unittest.TestCase):
 
         z = ZadaraController('foo', security_token='bar')
         self.assertEqual(z.security_token, 'bar')
+
+    @patch.object(requests.Session, 'request')
+    def test_shared_http_client(self, mock_request):
+
+        mock_request.return_value = Mock(
+            status_code=200, content='{"vpsa": {"status": "created"}}')
+        z = ZadaraController('foo', security_token='bar')
+        client = utils.http_client()
+        self.assertTrue(z.is_up())
+        self.assertTrue(z.is_up())
+        self.assertIs(utils.http_client(), client)
+
+        # both requests went through the same pooled session
+        self.assertEqual(mock_request.call_count, 2)
+        args, kwargs = mock_request.call_args
+        self.assertEqual(args, ('GET', 'https://manage.zadarastorage.com/api/vpsas/foo.json?token=bar'))
+        self.assertEqual(kwargs['timeout'], client.timeout)
+
+        z.resume()
+        args, kwargs = mock_request.call_args
+        self.assertEqual(args[0], 'POST')
+        self.assertEqual(kwargs['data'], '')
+
+        mock_request.return_value = Mock(status_code=500)
+        self.assertRaisesRegexp(Exception, "status code 500", z.get_vpsa_state)
+
+    @patch.object(requests.adapters.HTTPAdapter, 'send')
+    def test_state_not_cached(self, mock_send):
+
+        def send(request, **kwargs):
+            resp = requests.Response()
+            resp.status_code = 200
+            resp.request = request
+            resp.url = request.url
+            resp._content = '{"vpsa": {"status": "%s"}}' % states.pop(0)
+            return resp
+        states = ['launching', 'created']
+        mock_send.side_effect = send
+
+        # importing pyhorn makes every new session a caching one
+        self.assertTrue(issubclass(requests.Session, requests_cache.CachedSession))
+        z = ZadaraController('foo', security_token='bar')
+        self.assertEqual(z.get_vpsa_state(), 'launching')
+        self.assertEqual(z.get_vpsa_state(), 'created')
+        self.assertEqual(mock_send.call_count, 2)
+
+    @patch.object(requests.Session, 'request')
+    def test_request_deadline(self, mock_request):
+
+        mock_request.return_value = Mock(status_code=200, content='')
+        utils.http_request('http://example.edu', '/foo', timeout=10,
+                           deadline=utils.Deadline(3))
+        self.assertLessEqual(mock_request.call_args[1]['timeout'], 3)
+
+        utils.http_request('http://example.edu', '/foo', timeout=1,
+                           deadline=utils.Deadline(3))
+        self.assertEqual(mock_request.call_args[1]['timeout'], 1)
+
+        mock_request.reset_mock()
+        self.assertRaises(DeadlineExceeded, utils.http_request,
+                          'http://example.edu', '/foo', deadline=utils.Deadline(0))
+        self.assertFalse(mock_request.called)
+
+    def test_digest_auth_cached(self):
+
+        client = utils.HttpClient()
+        auth = client.digest_auth('http://foo')
+        self.assertIs(client.digest_auth('http://foo'), auth)
+        self.assertIsNot(client.digest_auth('http://bar'), auth)
@@ -1,65 +1,315 @@
 from functools import wraps
+import os
 import re
 import sys
 import json
+import time
 import click
-import urllib
-import urllib2
+import fcntl
 import logging
-import arrow
-from pyloggly import LogglyHandler
+import logging.handlers
+import tempfile
+import threading
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from unipath import Path
-from controllers.exceptions import ClusterException
+from controllers.exceptions import ClusterException, DeadlineExceeded
 
 import settings
 
 log = logging.getLogger('ec2-manager')
 
-def http_request(server, endpoint, post_data=None, special_request=None, content_type=None):
-
-# I'm going to leave these here since the urllib2 docs suck even more than the pycurl docs
-# Uncomment the lines below to setup debugging on the connection itself.  It's not byte-for-byte, nor formatted well
-# but it works, and is clear about what's being sent
-#    hh = urllib2.HTTPHandler()
-#    hsh = urllib2.HTTPSHandler()
-#    hh.set_http_debuglevel(1)
-#    hsh.set_http_debuglevel(1)
-#    opener = urllib2.build_opener(hh, hsh)
-#    urllib2.install_opener(opener)
-
-    url = '%s%s' % (server, endpoint)
-
-    headers = {}
-    if content_type:
-        headers['Content-Type'] = content_type
-
-    if special_request is not None and "MATTERHORN" in special_request:
-      cookie_handler = urllib2.HTTPCookieProcessor()
-      opener = urllib2.build_opener(cookie_handler)
-      urllib2.install_opener(opener)
-      auth_handler = urllib2.HTTPDigestAuthHandler()
-      auth_handler.add_password(realm=settings.MATTERHORN_REALM,
-                        uri=url,
-                        user=settings.MATTERHORN_ADMIN_SERVER_USER,
-                        passwd=settings.MATTERHORN_ADMIN_SERVER_PASS)
-      opener = urllib2.build_opener(auth_handler)
-      urllib2.install_opener(opener)
-      headers = dict(headers.items() + settings.MATTERHORN_HEADERS.items())
-    elif special_request is not None and "ZADARA_POST" in special_request:
-      #Ensure we're posting...
-      #Some Zadara endpoints require an empty POST, which turns out to be difficult to do without this trick
-      if post_data == None:
-        post_data=""
-
-    if post_data == None:
-      req = urllib2.Request(url, headers=headers)
-    else:
-      req = urllib2.Request(url, data=urllib.urlencode(post_data), headers=headers)
-    response = urllib2.urlopen(req, timeout=2)
-    if response.getcode() / 100 != 2:
-        raise Exception('ERROR: Request to %s failed (HTTP status code %i)' %
-                        (endpoint, status))
-    return response.read()
+class Deadline(object):
+    """
+    The time by which an operation, which may be several requests, has to
+    be done. Each request made on its behalf uses the time remaining as its
+    timeout, so the whole operation is bounded without needing signals
+    and is safe to use from any thread.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = time.time() + seconds
+
+    def remaining(self):
+        return max(self.expires - time.time(), 0)
+
+    def timeout(self, default=None):
+        """
+        a request timeout of the time remaining, capped at `default`. Raises
+        DeadlineExceeded if there's no time left.
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(
+                "Deadline of {}s exceeded".format(self.seconds))
+        if default is None:
+            return remaining
+        return min(default, remaining)
+
+class HttpClient(object):
+    """
+    Keep-alive http client shared by everything that calls http_request().
+    Connections are pooled and reused per host, and digest auth state is
+    kept per server so that later requests don't repeat the 401 challenge.
+    """
+
+    def __init__(self, timeout=None):
+        if timeout is None:
+            timeout = settings.EC2M_HTTP_TIMEOUT
+        self.timeout = timeout
+        # requests is only imported by those that need it
+        import requests
+        self.session = requests.Session()
+        # pyhorn installs requests_cache globally at import, which would make
+        # this a caching session and have polling see the same response
+        self.session._is_cache_disabled = True
+        self._digest_auth = {}
+
+    def digest_auth(self, server):
+        if server not in self._digest_auth:
+            from requests.auth import HTTPDigestAuth
+            self._digest_auth[server] = HTTPDigestAuth(
+                settings.MATTERHORN_ADMIN_SERVER_USER,
+                settings.MATTERHORN_ADMIN_SERVER_PASS
+            )
+        return self._digest_auth[server]
+
+    def request(self, server, endpoint, post_data=None, special_request=None,
+                content_type=None, timeout=None, deadline=None):
+
+        url = '%s%s' % (server, endpoint)
+
+        headers = {}
+        if content_type:
+            headers['Content-Type'] = content_type
+
+        auth = None
+        if special_request is not None and "MATTERHORN" in special_request:
+            auth = self.digest_auth(server)
+            headers.update(settings.MATTERHORN_HEADERS)
+        elif special_request is not None and "ZADARA_POST" in special_request:
+            # Some Zadara endpoints require an empty POST
+            if post_data is None:
+                post_data = ""
+
+        if timeout is None:
+            timeout = self.timeout
+        if deadline is not None:
+            timeout = deadline.timeout(timeout)
+
+        method = post_data is None and 'GET' or 'POST'
+        resp = self.session.request(method, url, data=post_data, headers=headers,
+                                    auth=auth, timeout=timeout)
+        if resp.status_code / 100 != 2:
+            raise Exception('ERROR: Request to %s failed (HTTP status code %i)' %
+                            (endpoint, resp.status_code))
+        return resp.content
+
+_http_client = None
+
+def http_client():
+    global _http_client
+    if _http_client is None:
+        _http_client = HttpClient()
+    return _http_client
+
+def http_request(server, endpoint, post_data=None, special_request=None,
+                 content_type=None, timeout=None, deadline=None):
+    return http_client().request(server, endpoint, post_data, special_request,
+                                 content_type, timeout, deadline)
+
+_file_locks = {}
+_file_locks_guard = threading.Lock()
+
+@contextmanager
+def locked_file(path):
+    """
+    Exclusive access to `path` for a read-modify-write, across threads by
+    way of a lock per path and across processes by way of an flock on a
+    `path`.lock file
+    """
+    with _file_locks_guard:
+        lock = _file_locks.setdefault(str(path), threading.Lock())
+    with lock:
+        try:
+            if not path.parent.exists():
+                os.makedirs(path.parent, 0700)
+            fd = os.open(path + '.lock', os.O_WRONLY | os.O_CREAT, 0600)
+        except OSError, e:
+            # carry on unlocked; the write will most likely fail too
+            log.warning("Unable to lock %s: %s", path, str(e))
+            fd = None
+        try:
+            if fd is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+def replace_file(path, write):
+    """
+    Replace `path` with what `write` writes to the file object it's given,
+    via a private temp file and a rename so readers never see a partial file
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            write(f)
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+class FileCache(object):
+    """
+    Keeps small json-serializable values between runs in a file under
+    EC2M_CACHE_DIR. Entries older than `ttl` seconds are ignored. The file
+    is only readable by its owner as some of what's cached is sensitive.
+    """
+
+    def __init__(self, name, ttl=None):
+        self.path = Path(settings.EC2M_CACHE_DIR, name + '.json')
+        self.ttl = ttl
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write(self, data):
+        try:
+            replace_file(self.path, lambda f: json.dump(data, f))
+        except (IOError, OSError), e:
+            log.warning("Unable to write cache file %s: %s", self.path, str(e))
+
+    def _value(self, entry, default):
+        if entry is None:
+            return default
+        if self.ttl is not None and time.time() - entry['stored'] > self.ttl:
+            return default
+        return entry['value']
+
+    def get(self, key, default=None):
+        return self._value(self._read().get(key), default)
+
+    def update(self, key, func, default=None):
+        """
+        Replace the value of `key` with `func(current value)` while holding
+        the cache's lock, so concurrent updates all take effect. A new value
+        of None removes the entry. Returns the new value.
+        """
+        with locked_file(self.path):
+            data = self._read()
+            value = func(self._value(data.get(key), default))
+            if value is not None:
+                data[key] = {'value': value, 'stored': time.time()}
+            elif key in data:
+                del data[key]
+            else:
+                return value
+            self._write(data)
+        return value
+
+    def set(self, key, value):
+        self.update(key, lambda current: value)
+
+    def delete(self, key):
+        if not self.path.exists():
+            # nothing to delete, so no need for the directory or a lock file
+            return
+        self.update(key, lambda current: None)
+
+class CircuitBreaker(object):
+    """
+    Tracks consecutive failures talking to a service, with the state kept
+    in a FileCache so it carries over between runs. After `threshold`
+    failures in a row the circuit opens and `allow()` refuses calls for
+    `cooldown` seconds. After that the circuit is half-open and one caller
+    gets to try again (others keep failing fast). If that call works the
+    circuit closes; if not it stays open for another cooldown.
+    """
+
+    def __init__(self, name, threshold, cooldown):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.cache = FileCache('circuit_breakers')
+        self.probing = False
+
+    def _state(self):
+        return self.cache.get(self.name) or {'failures': 0, 'opened': None}
+
+    def allow(self):
+        if self.threshold <= 0 or self.probing:
+            return True
+        state = self._state()
+        if state['opened'] is None:
+            return True
+        if time.time() - state['opened'] < self.cooldown:
+            return False
+
+        # half-open; restart the cooldown so concurrent runs don't also probe.
+        # checked again under the cache's lock so only one of them gets to
+        def claim(state):
+            if state is not None and state['opened'] is not None \
+                    and time.time() - state['opened'] >= self.cooldown:
+                state['opened'] = time.time()
+                self.probing = True
+            return state
+        state = self.cache.update(self.name, claim)
+        if self.probing:
+            log.debug("Circuit %s half-open; trying again", self.name)
+            return True
+        return state is None or state['opened'] is None
+
+    def record_success(self):
+        self.probing = False
+        if self._state()['failures']:
+            log.debug("Circuit %s closed", self.name)
+            self.cache.delete(self.name)
+
+    def record_failure(self):
+        self.probing = False
+        if self.threshold <= 0:
+            return
+
+        def fail(state):
+            if state is None:
+                state = {'failures': 0, 'opened': None}
+            state['failures'] += 1
+            if state['failures'] >= self.threshold:
+                log.debug("Circuit %s open after %d failures", self.name, state['failures'])
+                state['opened'] = time.time()
+            return state
+        self.cache.update(self.name, fail)
+
+def concurrent_map(func, items, max_workers):
+    """
+    Call `func` on each of `items` using a bounded pool of threads. Returns a
+    list of (item, result, exception) tuples in the same order as `items`.
+    """
+    def call(item):
+        try:
+            return item, func(item), None
+        # SystemExit too, as it would otherwise kill the pool's worker thread
+        # and leave map() waiting forever
+        except BaseException, e:
+            return item, None, e
+
+    if not len(items):
+        return []
+
+    # a concurrency setting of 0 means one at a time rather than an error
+    pool = ThreadPool(max(1, min(max_workers, len(items))))
+    try:
+        return pool.map(call, items)
+    finally:
+        pool.close()
+        pool.join()
 
 def init_logging(cluster, verbose, stdout_level=logging.INFO):
 
@@ -96,9 +346,10 @@ def init_logging(cluster, verbose, stdout_level=logging.INFO):
 
     log.debug("logging to %s", log_path)
 
-    if hasattr(settings, 'LOGGLY_TOKEN'):
+    if settings.LOGGLY_TOKEN:
+        from loggly_handler import BulkLogglyHandler
         cluster_tag = re.sub('\s+', '_', cluster)
-        loggly_handler = LogglyHandler(
+        loggly_handler = BulkLogglyHandler(
             settings.LOGGLY_TOKEN,
             settings.LOGGLY_URL,
             tags=cluster_tag + ',' + settings.LOGGLY_TAGS
@@ -138,6 +389,7 @@ def format_status(stats, format):
         raise NotImplementedError('Ooops! Not implemented yet!')
 
 def total_uptime(inst):
+    import arrow
     launch_time = arrow.get(inst.launch_time)
     now = arrow.utcnow()
     if launch_time > now: